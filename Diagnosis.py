@@ -1,34 +1,112 @@
 # Diagnosis.py
-from flask import Flask, render_template, request, flash, redirect, url_for, send_file, jsonify
+from flask import Flask, render_template, request, flash, redirect, url_for, send_file, jsonify, make_response, current_app
 import os
 from werkzeug.utils import secure_filename
 import csv
-import json
 import threading
-from tabulate import tabulate
+import hashlib
+import hmac
+import io
+import uuid
+from functools import wraps
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from inference_daemon import InferenceClient, DaemonUnavailable
+from join_index import build_scheduling_index, build_insurance_index, load_optional_index
+# The matching engine lives in diagnosis_core; its names are re-exported here
+# for existing `from Diagnosis import ...` callers.
+from diagnosis_core import (
+    DIAGNOSIS_MATCH_THRESHOLD, DIFFERENTIAL_TOP_K, UNKNOWN_DIAGNOSIS, RESULT_FIELDNAMES, SEVERITY_LABELS,
+    read_csv, write_csv, write_json, extract_symptoms_from_csv_row, normalize_symptoms,
+    calculate_symptom_match_score, diagnose_patient, build_condition_index, rank_conditions,
+    diagnose_patient_topk, diagnose_csv_row, validate_csv_structure, _join_uploads,
+)
 import logging
 from datetime import datetime
 import re
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-app.secret_key = 'your_secret_key_here'
-
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'csv'}  # Changed to only allow CSV files
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-
-# Ensure upload directory exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # ── AI chatbot model (lazy-loaded on first request) ──────────────────────────
 _ai_model = None
 _ai_tokenizer = None
 _ai_model_lock = threading.Lock()
 
+# Flan-T5 reads at most 512 input tokens. Prompts built with _build_prompt are
+# trimmed to this budget by _encode_prompt instead of being cut by the
+# tokenizer, which used to drop the user's question at the end.
+AI_MAX_INPUT_TOKENS = 512
+PROMPT_ENCODE_BATCH = 16
+_prompt_token_cache = {}
+
+# ── Bounded inference executor ──────────────────────────────────────────────
+# Generation runs on a fixed pool of inference slots instead of the request
+# thread, so a burst of /chat calls cannot tie up every server thread. Requests
+# beyond the slots wait in a bounded queue; once that is full they are rejected
+# immediately and /chat answers with 429 or the deterministic summary.
+AI_INFERENCE_SLOTS = max(1, int(os.environ.get('AI_INFERENCE_SLOTS', 1)))
+AI_INFERENCE_QUEUE = max(0, int(os.environ.get('AI_INFERENCE_QUEUE', 4)))
+AI_INFERENCE_TIMEOUT = float(os.environ.get('AI_INFERENCE_TIMEOUT', 120))
+AI_RETRY_AFTER_SECONDS = 10
+AI_BUSY_ERROR = 'AI inference queue is full'
+
+_ai_executor = ThreadPoolExecutor(
+    max_workers=AI_INFERENCE_SLOTS, thread_name_prefix='ai-inference'
+)
+_ai_in_flight = 0
+_ai_in_flight_lock = threading.Lock()
+
+# ── Precomputed AI summaries ─────────────────────────────────────────────────
+# After /process writes results, a background task generates the AI summary
+# and stores it keyed on a fingerprint of the results file. The "Generate AI
+# Summary" request then returns it, or joins the generation still in flight.
+# The background task only starts generating once an inference slot is idle;
+# until then, summary requests fall back instead of waiting for it.
+AI_SUMMARY_PRECOMPUTE = os.environ.get('AI_SUMMARY_PRECOMPUTE', '1') != '0'
+AI_SUMMARY_CACHE_SIZE = 8
+AI_SUMMARY_BUSY_RETRIES = 30
+AI_SUMMARY_SUPERSEDED_ERROR = 'Superseded by a newer diagnosis run'
+
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ai-summary')
+_summary_cache = OrderedDict()
+_summary_pending = set()  # background runs still waiting for an idle slot
+_summary_cache_lock = threading.Lock()
+_latest_results_fingerprint = None
+
+# ── On-demand request profiling ──────────────────────────────────────────────
+# Send "X-Profile: 1" (or ?profile=1) to /process, /results or /chat to run that
+# one request under cProfile and tracemalloc. Allowed from localhost or with
+# "X-Admin-Token: $PROFILE_ADMIN_TOKEN". Requests without the flag skip it
+# after a single header lookup. A profiled request runs its AI generation on
+# the request thread, because cProfile only sees the thread it was enabled on.
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', 'profiles')
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN')
+PROFILE_ALLOW_LOCALHOST = os.environ.get('PROFILE_ALLOW_LOCALHOST', '1') != '0'
+PROFILE_TOP_N = 30
+_profile_lock = threading.Lock()
+_profile_context = threading.local()
+
+# ── Cohort analytics (NumPy, optional) ──────────────────────────────────────
+# The columnar frame for the current results file is built once per results
+# fingerprint and shared by /api/analytics and /chat. Like transformers, numpy
+# is listed in requirements.txt but imported lazily; without it /api/analytics
+# answers 503 and /chat skips cohort answers.
+_cohort_frame_cache = (None, None)
+_cohort_frame_lock = threading.Lock()
+_cohort_import_warned = False
+
+# ── Shared inference daemon (optional) ───────────────────────────────────────
+# When AI_DAEMON_SOCKET is set, generation is delegated to inference_daemon.py,
+# which holds one model copy for all workers. The in-process model is only
+# loaded if the daemon cannot be reached.
+AI_DAEMON_SOCKET = os.environ.get('AI_DAEMON_SOCKET')
+_ai_daemon_client = None
+_ai_daemon_client_lock = threading.Lock()
+
 
 def _load_ai_model():
     """Lazily load and cache the Flan-T5-Small model. Thread-safe."""
@@ -64,8 +142,6 @@ def _build_results_context(results):
     diagnoses = {}
     severities = {}
     prescriptions = set()
-    sev_labels = {'10245': 'High', '10246': 'Medium', '10247': 'Low'}
-
     for r in results:
         diag = r.get('diagnosis', 'Unknown')
         sev = r.get('Severity', r.get('severity', 'Unknown'))
@@ -79,7 +155,7 @@ def _build_results_context(results):
         f"{k} ({v} patient{'s' if v > 1 else ''})" for k, v in diagnoses.items()
     )
     sev_text = '; '.join(
-        f"{sev_labels.get(k, k)}: {v}" for k, v in severities.items()
+        f"{SEVERITY_LABELS.get(k, k)}: {v}" for k, v in severities.items()
     )
     pres_text = '; '.join(list(prescriptions)[:5]) if prescriptions else 'None'
 
@@ -92,12 +168,7 @@ def _build_results_context(results):
 
 
 def _severity_label(code):
-    severity_labels = {
-        '10245': 'High',
-        '10246': 'Medium',
-        '10247': 'Low'
-    }
-    return severity_labels.get(str(code), str(code) if code else 'Unknown')
+    return SEVERITY_LABELS.get(str(code), str(code) if code else 'Unknown')
 
 
 def _compute_results_analytics(results):
@@ -142,31 +213,126 @@ def _compute_results_analytics(results):
     return analytics
 
 
-def _format_analytics_for_prompt(analytics):
+def _analytics_prompt_entries(analytics):
+    """Turn analytics into ranked prompt entries for the token-budgeted prompt builder.
+
+    Each entry is [text, priority]; lower priorities are kept first when the
+    prompt has to be trimmed. Headline totals always rank first, then every
+    distribution item ranks by its patient count, so rare values are the
+    first to go for a diverse cohort.
+    """
     total = analytics['total_patients']
     if total == 0:
-        return "No diagnosis records are available."
+        return [["No diagnosis records are available.", [0, 0]]]
 
-    def _fmt_distribution(distribution, mapper=None):
-        if not distribution:
-            return "None"
-        parts = []
+    entries = [
+        [f"Total patients: {total}.", [0, 0]],
+        [f"Unknown diagnoses: {analytics['unknown_diagnoses']}.", [0, 1]],
+    ]
+    distributions = (
+        ('Diagnosis', analytics['diagnosis_counts'], None),
+        ('Severity', analytics['severity_counts'], _severity_label),
+        ('Affected eye', analytics['eye_counts'], None),
+        ('Diagnosis status', analytics['status_counts'], None),
+        ('Prescription', analytics['prescription_counts'], None),
+    )
+    for name, distribution, mapper in distributions:
         for key, count in sorted(distribution.items(), key=lambda item: item[1], reverse=True):
             label = mapper(key) if mapper else key
-            share = (count / total) * 100 if total else 0
-            parts.append(f"{label}: {count} ({share:.1f}%)")
-        return "; ".join(parts)
+            share = (count / total) * 100
+            entries.append([f"{name} {label}: {count} ({share:.1f}%).", [2, -count]])
+    return entries
+
+
+def _build_prompt(instruction, sections, answer_cue, question=None):
+    """Describe a /chat prompt as parts the model-side encoder can fit to the token budget.
+
+    `sections` is a list of (label, entries) pairs, where entries come from
+    _analytics_prompt_entries or similar. The result is JSON-serializable so
+    it can be sent to the inference daemon unchanged.
+    """
+    return {
+        'instruction': instruction,
+        'sections': [{'label': label, 'entries': entries} for label, entries in sections],
+        'question': question,
+        'answer_cue': answer_cue,
+    }
 
-    return (
-        f"Total patients: {total}. "
-        f"Top diagnoses: {_fmt_distribution(dict(analytics['top_diagnoses']))}. "
-        f"All diagnoses: {_fmt_distribution(analytics['diagnosis_counts'])}. "
-        f"Severity distribution: {_fmt_distribution(analytics['severity_counts'], _severity_label)}. "
-        f"Affected eye distribution: {_fmt_distribution(analytics['eye_counts'])}. "
-        f"Diagnosis status distribution: {_fmt_distribution(analytics['status_counts'])}. "
-        f"Prescription distribution: {_fmt_distribution(analytics['prescription_counts'])}. "
-        f"Unknown diagnoses: {analytics['unknown_diagnoses']}."
+
+def _encode_cached(tokenizer, text):
+    """Token ids for a static prompt fragment, tokenized once per process."""
+    ids = _prompt_token_cache.get(text)
+    if ids is None:
+        ids = tuple(tokenizer(text, add_special_tokens=False)['input_ids'])
+        _prompt_token_cache[text] = ids
+    return ids
+
+
+def _encode_prompt(prompt, tokenizer, max_tokens=None):
+    """Encode a _build_prompt spec into at most max_tokens input ids.
+
+    The instruction, section labels and answer cue use cached ids. The
+    question is always kept; dataset entries are added in priority order
+    until the budget runs out, and are tokenized in small batches so text
+    that cannot fit is never tokenized.
+    """
+    if max_tokens is None:
+        max_tokens = AI_MAX_INPUT_TOKENS
+    instruction_ids = _encode_cached(tokenizer, prompt['instruction'])
+    cue_ids = _encode_cached(tokenizer, prompt['answer_cue'])
+    question_ids = ()
+    if prompt.get('question'):
+        question_ids = _encode_cached(tokenizer, 'Question:') + tuple(
+            tokenizer(prompt['question'], add_special_tokens=False)['input_ids']
+        )
+
+    eos = () if tokenizer.eos_token_id is None else (tokenizer.eos_token_id,)
+    fixed = len(instruction_ids) + len(cue_ids) + len(eos)
+    # A question longer than the whole budget is cut at its end, never dropped.
+    question_ids = question_ids[:max(0, max_tokens - fixed)]
+    budget = max_tokens - fixed - len(question_ids)
+
+    ranked = sorted(
+        (
+            (entry[1], section_index, entry_index, entry[0])
+            for section_index, section in enumerate(prompt['sections'])
+            for entry_index, entry in enumerate(section['entries'])
+        ),
+        key=lambda item: item[:3],
     )
+    kept = {}
+    label_ids = {}
+    exhausted = False
+    for start in range(0, len(ranked), PROMPT_ENCODE_BATCH):
+        batch = ranked[start:start + PROMPT_ENCODE_BATCH]
+        batch_ids = tokenizer([item[3] for item in batch], add_special_tokens=False)['input_ids']
+        for (_priority, section_index, entry_index, _text), ids in zip(batch, batch_ids):
+            new_section = section_index not in label_ids
+            section_label_ids = (
+                _encode_cached(tokenizer, prompt['sections'][section_index]['label']) if new_section else ()
+            )
+            cost = len(ids) + len(section_label_ids)
+            if cost > budget:
+                exhausted = True
+                break
+            if new_section:
+                label_ids[section_index] = section_label_ids
+            kept[(section_index, entry_index)] = ids
+            budget -= cost
+        if exhausted:
+            break
+
+    ids = list(instruction_ids)
+    for section_index, section in enumerate(prompt['sections']):
+        if section_index not in label_ids:
+            continue
+        ids.extend(label_ids[section_index])
+        for entry_index in range(len(section['entries'])):
+            ids.extend(kept.get((section_index, entry_index), ()))
+    ids.extend(question_ids)
+    ids.extend(cue_ids)
+    ids.extend(eos)
+    return ids
 
 
 def _build_structured_summary(analytics):
@@ -214,6 +380,20 @@ def _build_structured_summary(analytics):
     )
 
 
+SUMMARY_PROMPT_INSTRUCTION = (
+    "You are a clinical data analyst assistant. "
+    "Create a clear, professional summary with concrete numbers and practical interpretation. "
+    "Do not use generic filler. Keep all facts consistent with the data. "
+    "Include sections: Key Findings, Risk Priorities, and Recommended Actions."
+)
+
+QUESTION_PROMPT_INSTRUCTION = (
+    "You are a professional medical assistant for an eye diagnosis dashboard. "
+    "Answer the user question using the dataset facts with concrete numbers and concise interpretation. "
+    "If the question is ambiguous, answer with the best available data and suggest one precise follow-up question."
+)
+
+
 def _is_summary_request(message):
     text = message.lower()
     return any(keyword in text for keyword in (
@@ -302,6 +482,119 @@ def _answer_analytics_question(message, analytics):
     return None
 
 
+def _get_cohort_frame(raw_results, results=None):
+    """Return the CohortFrame for a results file's bytes, or None if NumPy is missing."""
+    global _cohort_frame_cache, _cohort_import_warned
+    try:
+        from analytics_engine import CohortFrame
+    except ImportError as exc:
+        if not _cohort_import_warned:
+            _cohort_import_warned = True
+            logger.warning("Cohort analytics unavailable: %s. Install with: pip install numpy", exc)
+        return None
+
+    fingerprint = _results_fingerprint(raw_results)
+    with _cohort_frame_lock:
+        cached_fingerprint, frame = _cohort_frame_cache
+        if cached_fingerprint == fingerprint:
+            return frame
+    if results is None:
+        results = list(csv.DictReader(io.StringIO(raw_results.decode('utf-8'))))
+    frame = CohortFrame.from_rows(results)
+    with _cohort_frame_lock:
+        _cohort_frame_cache = (fingerprint, frame)
+    return frame
+
+
+def _parse_cohort_question(message):
+    """Extract a cohort query from questions like "high severity by eye in the last 30 days".
+
+    Returns (group_by, filters, last_days), or None unless the question has a
+    time window or asks for counts ("how many", "count", "breakdown", ...)
+    by a dimension. Other "per diagnosis" questions are left to the model.
+    """
+    text = message.lower()
+    dimension = r'(diagnosis|severity|eye|status)'
+    breakdown = re.search(rf'\b(?:by|per) {dimension}(?:(?: and|,) {dimension})?\b', text)
+    group_by = [dim for dim in breakdown.groups() if dim] if breakdown else []
+
+    last_days = None
+    window = re.search(r'\b(?:last|past) (\d+) days?\b', text)
+    if window:
+        last_days = int(window.group(1))
+    elif re.search(r'\b(?:last|past) week\b', text):
+        last_days = 7
+    elif re.search(r'\b(?:last|past) month\b', text):
+        last_days = 30
+
+    counting = re.search(r'\b(how many|counts?|number of|breakdown|break down|distribution|split)\b', text)
+    if last_days is None and not (group_by and counting):
+        return None
+
+    filters = {}
+    severity = re.search(r'\b(high|medium|low)[ -](?:severity|risk)\b', text)
+    if severity:
+        filters['severity'] = severity.group(1)
+    eye = re.search(r'\b(left|right|both)[ -]eyes?\b', text)
+    if eye:
+        filters['eye'] = eye.group(1)
+    status = re.search(r'\b(active|relapse)\b', text)
+    if status:
+        filters['status'] = status.group(1)
+    return group_by, filters, last_days
+
+
+def _answer_cohort_question(message, frame):
+    """Answer group-by, cross-tab and time-window questions from the cohort frame."""
+    parsed = _parse_cohort_question(message)
+    if parsed is None or frame is None:
+        return None
+    group_by, filters, last_days = parsed
+
+    scope = ' '.join(f"{value} {name}" for name, value in filters.items()) or 'all'
+    scope = f"{scope} patients"
+    if last_days is not None:
+        scope += f" with onset in the last {last_days} days"
+
+    from analytics_engine import AnalyticsError
+    try:
+        if not group_by:
+            matched = int(frame.mask(filters, last_days=last_days).sum())
+            return f"{scope[0].upper()}{scope[1:]}: {matched} of {frame.size}."
+        result = frame.query(group_by, filters, last_days=last_days)
+    except AnalyticsError as exc:
+        # Let the other answer paths handle questions the frame cannot (e.g. huge windows).
+        logger.info("Cohort question not answered: %s", exc)
+        return None
+
+    if len(group_by) == 1:
+        counts = result['counts']
+        breakdown = ', '.join(f"{label}: {count}" for label, count in counts.items()) or 'none'
+    else:
+        table = result['crosstab']
+        breakdown = '; '.join(
+            f"{row} - " + ', '.join(f"{col}: {count}" for col, count in zip(table['columns'], counts) if count)
+            for row, counts in zip(table['rows'], table['counts'])
+        ) or 'none'
+    return (
+        f"{scope[0].upper()}{scope[1:]} by {' and '.join(group_by)} "
+        f"({result['matched']} of {result['total']}): {breakdown}."
+    )
+
+
+def _cohort_prompt_entries(frame):
+    """Severity-by-eye cross-tab cells as low-priority prompt entries."""
+    if frame is None:
+        return []
+    table = frame.crosstab('severity', 'eye')
+    return [
+        [f"Severity {row}, eye {col}: {count}.", [3, -count]]
+        for row, counts in zip(table['rows'], table['counts'])
+        for col, count in zip(table['columns'], counts)
+        if count
+    ]
+
+
 def _response_is_too_generic(response_text, total_patients):
     if not response_text:
         return True
@@ -322,7 +615,32 @@ def _response_is_too_generic(response_text, total_patients):
     return False
 
 
+def _get_ai_daemon_client():
+    global _ai_daemon_client
+    if not AI_DAEMON_SOCKET:
+        return None
+    with _ai_daemon_client_lock:
+        if _ai_daemon_client is None or _ai_daemon_client.socket_path != AI_DAEMON_SOCKET:
+            _ai_daemon_client = InferenceClient(
+                AI_DAEMON_SOCKET,
+                pool_size=AI_INFERENCE_SLOTS + AI_INFERENCE_QUEUE,
+                timeout=AI_INFERENCE_TIMEOUT,
+            )
+        return _ai_daemon_client
+
+
 def _generate_ai_response(prompt):
+    """Generate a response via the inference daemon if configured, else in-process."""
+    client = _get_ai_daemon_client()
+    if client is not None:
+        try:
+            return client.generate(prompt)
+        except DaemonUnavailable as exc:
+            logger.warning("AI daemon unavailable, falling back to in-process model: %s", exc)
+    return _generate_ai_response_local(prompt)
+
+
+def _generate_ai_response_local(prompt):
     """Generate a response from the local Flan-T5-Small model."""
     with _ai_model_lock:
         success, error = _load_ai_model()
@@ -331,9 +649,13 @@ def _generate_ai_response(prompt):
 
     try:
         import torch
-        inputs = _ai_tokenizer(
-            prompt, return_tensors='pt', max_length=512, truncation=True
-        )
+        if isinstance(prompt, dict):
+            input_ids = torch.tensor([_encode_prompt(prompt, _ai_tokenizer)])
+            inputs = {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids)}
+        else:
+            inputs = _ai_tokenizer(
+                prompt, return_tensors='pt', max_length=AI_MAX_INPUT_TOKENS, truncation=True
+            )
         with torch.no_grad():
             outputs = _ai_model.generate(
                 **inputs,
@@ -348,163 +670,279 @@ def _generate_ai_response(prompt):
         logger.error("AI generation error: %s", exc)
         return None, str(exc)
 
-def allowed_file(filename):
-    if not filename:
-        return False
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def read_csv(file_name):
-    """Reads a CSV file and returns a list of dictionaries."""
+def _ai_inference_load():
+    """Return how many generations are admitted right now (running or queued)."""
+    with _ai_in_flight_lock:
+        return _ai_in_flight
+
+
+def _admit_ai_request(limit=None):
+    """Take an admission if fewer than `limit` (default: slots + queue) are in flight."""
+    global _ai_in_flight
+    if limit is None:
+        limit = AI_INFERENCE_SLOTS + AI_INFERENCE_QUEUE
+    with _ai_in_flight_lock:
+        if _ai_in_flight >= limit:
+            return False
+        _ai_in_flight += 1
+        return True
+
+
+def _release_ai_request(_future=None):
+    global _ai_in_flight
+    with _ai_in_flight_lock:
+        _ai_in_flight -= 1
+
+
+def _submit_ai_response(prompt):
+    """Run _generate_ai_response on the bounded executor.
+
+    Returns (None, AI_BUSY_ERROR) without waiting when every inference slot
+    and queue position is taken.
+    """
+    if not _admit_ai_request():
+        logger.warning("AI inference queue full; rejecting request")
+        return None, AI_BUSY_ERROR
+    return _run_admitted_ai_request(prompt)
+
+
+def _run_admitted_ai_request(prompt):
+    """Run _generate_ai_response on the executor for an already-admitted request."""
+    if getattr(_profile_context, 'active', False):
+        return _run_profiled_ai_request(prompt)
+
     try:
-        with open(file_name, mode='r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            data = list(reader)
-            logger.info(f"Successfully loaded {len(data)} records from {file_name}")
-            return data
-    except FileNotFoundError:
-        logger.error(f"Error: The file '{file_name}' was not found.")
-        return []
-    except Exception as e:
-        logger.error(f"An error occurred while reading '{file_name}': {e}")
-        return []
+        future = _ai_executor.submit(_generate_ai_response, prompt)
+    except Exception as exc:
+        _release_ai_request()
+        logger.error("Could not schedule AI generation: %s", exc)
+        return None, str(exc)
+    # Free the admission slot only when the work actually finishes, so a
+    # request that timed out below still counts against the queue.
+    future.add_done_callback(_release_ai_request)
+
+    try:
+        return future.result(timeout=AI_INFERENCE_TIMEOUT)
+    except FutureTimeoutError:
+        logger.error("AI generation timed out after %.0fs", AI_INFERENCE_TIMEOUT)
+        return None, 'AI generation timed out'
+
+
+def _run_profiled_ai_request(prompt):
+    """Generate on the request thread so the request's profiler sees the model work.
+
+    A placeholder executor task holds one inference slot meanwhile, so a
+    profiled request never runs more generations at once than AI_INFERENCE_SLOTS.
+    """
+    slot_taken = threading.Event()
+    generation_done = threading.Event()
+
+    def hold_slot():
+        slot_taken.set()
+        generation_done.wait()
+
+    try:
+        holder = _ai_executor.submit(hold_slot)
+    except Exception as exc:
+        _release_ai_request()
+        logger.error("Could not schedule AI generation: %s", exc)
+        return None, str(exc)
+    holder.add_done_callback(_release_ai_request)
+
+    try:
+        if not slot_taken.wait(AI_INFERENCE_TIMEOUT):
+            logger.error("No inference slot for profiled request after %.0fs", AI_INFERENCE_TIMEOUT)
+            return None, 'AI generation timed out'
+        return _generate_ai_response(prompt)
+    finally:
+        generation_done.set()
+
+def _results_fingerprint(raw_bytes):
+    return hashlib.sha256(raw_bytes).hexdigest()
+
+
+def _build_summary_prompt(analytics, deterministic_summary):
+    # Baseline summary lines rank just after the headline totals.
+    baseline_entries = [[line, [1, i]] for i, line in enumerate(deterministic_summary.splitlines()[1:])]
+    return _build_prompt(
+        SUMMARY_PROMPT_INSTRUCTION,
+        [('Dataset facts:', _analytics_prompt_entries(analytics)),
+         ('Baseline summary to preserve facts:', baseline_entries)],
+        'Final summary:',
+    )
+
 
-def write_csv(file_name, fieldnames, data):
-    """Writes a list of dictionaries to a CSV file."""
+def _claim_summary(fingerprint, background=False):
+    """Return (future, owner) for a results fingerprint.
+
+    The first caller becomes the owner and must run _run_summary_task; later
+    callers get the same future and may wait on it.
+    """
+    with _summary_cache_lock:
+        future = _summary_cache.get(fingerprint)
+        if future is not None:
+            _summary_cache.move_to_end(fingerprint)
+            return future, False
+        future = Future()
+        _summary_cache[fingerprint] = future
+        if background:
+            _summary_pending.add(fingerprint)
+        while len(_summary_cache) > AI_SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
+        return future, True
+
+
+def _submit_background_summary(fingerprint, prompt):
+    """Generate a background summary once an inference slot is idle.
+
+    Never takes a queue position, so it cannot delay an interactive /chat
+    request; once started, the generation holds its slot like any other.
+    Gives up when newer results replace these or after the busy retries.
+    """
+    for attempt in range(AI_SUMMARY_BUSY_RETRIES + 1):
+        if fingerprint != _latest_results_fingerprint:
+            return None, AI_SUMMARY_SUPERSEDED_ERROR
+        if _admit_ai_request(AI_INFERENCE_SLOTS):
+            with _summary_cache_lock:
+                _summary_pending.discard(fingerprint)
+            return _run_admitted_ai_request(prompt)
+        if attempt < AI_SUMMARY_BUSY_RETRIES:
+            time.sleep(AI_RETRY_AFTER_SECONDS / 5)
+    return None, AI_BUSY_ERROR
+
+
+def _run_summary_task(future, fingerprint, results, background=False):
+    """Generate the AI summary for `results` and resolve `future` with (response, error)."""
     try:
-        with open(file_name, mode='w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(data)
-        logger.info(f"Successfully wrote {len(data)} records to {file_name}")
+        analytics = _compute_results_analytics(results)
+        prompt = _build_summary_prompt(analytics, _build_structured_summary(analytics))
+        if background:
+            outcome = _submit_background_summary(fingerprint, prompt)
+        else:
+            outcome = _submit_ai_response(prompt)
+    except Exception as exc:
+        logger.error("AI summary task failed: %s", exc)
+        outcome = (None, str(exc))
+
+    with _summary_cache_lock:
+        _summary_pending.discard(fingerprint)
+        # Do not cache failures; the next request should try again.
+        if outcome[1] and _summary_cache.get(fingerprint) is future:
+            del _summary_cache[fingerprint]
+    future.set_result(outcome)
+
+
+def _schedule_summary_precompute(fingerprint, results):
+    """Queue a low-priority background AI summary for freshly written results."""
+    global _latest_results_fingerprint
+    _latest_results_fingerprint = fingerprint
+    if not AI_SUMMARY_PRECOMPUTE:
+        return
+    future, owner = _claim_summary(fingerprint, background=True)
+    if owner:
+        _summary_executor.submit(_run_summary_task, future, fingerprint, results, True)
+
+
+def _get_ai_summary(fingerprint, results):
+    """Return the (response, error) AI summary for results, generating it at most once.
+
+    Returns (None, AI_BUSY_ERROR) at once, rather than joining, while the
+    background run is still waiting for a slot or the inference queue is full.
+    """
+    future, owner = _claim_summary(fingerprint)
+    if owner:
+        _run_summary_task(future, fingerprint, results)
+    elif not future.done():
+        with _summary_cache_lock:
+            waiting = fingerprint in _summary_pending
+        if waiting or _ai_inference_load() >= AI_INFERENCE_SLOTS + AI_INFERENCE_QUEUE:
+            return None, AI_BUSY_ERROR
+    try:
+        return future.result(timeout=AI_INFERENCE_TIMEOUT)
+    except FutureTimeoutError:
+        return None, 'AI summary timed out'
+
+
+def _profiling_requested():
+    return request.headers.get('X-Profile') == '1' or request.args.get('profile') == '1'
+
+
+def _profiling_authorized():
+    token = request.headers.get('X-Admin-Token')
+    if PROFILE_ADMIN_TOKEN and token and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN):
         return True
-    except Exception as e:
-        logger.error(f"An error occurred while writing to '{file_name}': {e}")
-        return False
+    return PROFILE_ALLOW_LOCALHOST and request.remote_addr in ('127.0.0.1', '::1')
+
+
+def _write_profile_report(profile_id, profiler, snapshot):
+    """Save the pstats dump plus a text report of hot functions and allocation sites."""
+    import pstats
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    base = os.path.join(PROFILE_FOLDER, profile_id)
+    profiler.dump_stats(base + '.pstats')
+
+    with open(base + '.txt', mode='w', encoding='utf-8') as report:
+        report.write(f"Profile {profile_id}: {request.method} {request.full_path}\n\n")
+        report.write(f"== Top {PROFILE_TOP_N} functions by cumulative time ==\n")
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        report.write(f"\n== Top {PROFILE_TOP_N} allocation sites ==\n")
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP_N]:
+            report.write(f"{stat}\n")
+
+
+def profiled_route(view):
+    """Run a view under cProfile and tracemalloc when the request asks for it."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not _profiling_requested():
+            return view(*args, **kwargs)
+        if not _profiling_authorized():
+            logger.warning("Rejected profiling request from %s", request.remote_addr)
+            return view(*args, **kwargs)
+
+        import cProfile
+        import tracemalloc
+        profile_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{uuid.uuid4().hex[:8]}"
+        # One profiled request at a time: only one profiler can be active per process.
+        with _profile_lock:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            profiler = cProfile.Profile()
+            try:
+                _profile_context.active = True
+                profiler.enable()
+                try:
+                    response = make_response(view(*args, **kwargs))
+                finally:
+                    profiler.disable()
+                    _profile_context.active = False
+                snapshot = tracemalloc.take_snapshot()
+            finally:
+                if started_tracing:
+                    tracemalloc.stop()
+            try:
+                _write_profile_report(profile_id, profiler, snapshot)
+            except Exception as exc:
+                logger.error("Could not save profile %s: %s", profile_id, exc)
+                return response
 
-def extract_symptoms_from_csv_row(row):
-    """Extract symptoms from a CSV row. Handles various possible column names."""
-    symptoms = []
-    
-    # Common symptom column names
-    symptom_columns = [
-        'symptoms', 'symptom', 'patient_symptoms', 'eye_symptoms',
-        'symptom1', 'symptom2', 'symptom3', 'symptom4', 'symptom5',
-        'primary_symptom', 'secondary_symptom', 'tertiary_symptom'
-    ]
-    
-    for col in symptom_columns:
-        if col in row and row[col]:
-            # Handle both single symptoms and comma-separated lists
-            symptom_value = str(row[col]).strip()
-            if ',' in symptom_value:
-                # Split by comma and clean each symptom
-                symptom_list = [s.strip() for s in symptom_value.split(',') if s.strip()]
-                symptoms.extend(symptom_list)
-            else:
-                symptoms.append(symptom_value)
-    
-    # Remove duplicates while preserving order
-    seen = set()
-    unique_symptoms = []
-    for symptom in symptoms:
-        if symptom.lower() not in seen:
-            seen.add(symptom.lower())
-            unique_symptoms.append(symptom)
-    
-    return unique_symptoms
-
-def normalize_symptoms(symptoms):
-    """Normalize symptoms for better matching."""
-    normalized = []
-    for symptom in symptoms:
-        if symptom:
-            # Convert to lowercase and remove extra whitespace
-            clean_symptom = symptom.lower().strip()
-            normalized.append(clean_symptom)
-    return normalized
-
-def calculate_symptom_match_score(patient_symptoms, condition_symptoms):
-    """Calculate a match score between patient symptoms and condition symptoms."""
-    patient_normalized = normalize_symptoms(patient_symptoms)
-    condition_normalized = normalize_symptoms(condition_symptoms)
-    
-    if not patient_normalized or not condition_normalized:
-        return 0.0
-    
-    # Calculate intersection
-    intersection = set(patient_normalized) & set(condition_normalized)
-    
-    # Calculate Jaccard similarity
-    union = set(patient_normalized) | set(condition_normalized)
-    
-    if not union:
-        return 0.0
-    
-    return len(intersection) / len(union)
+        logger.info("Saved request profile %s", profile_id)
+        response.headers['X-Profile-Id'] = profile_id
+        return response
+    return wrapper
 
-def diagnose_patient(symptoms, icd_data):
-    """Finds the best-matching ICD code for the given symptoms using improved algorithm."""
-    best_match = None
-    best_score = 0.0
-    
-    for row in icd_data:
-        condition_symptoms = [
-            row.get("symptom1", "").strip(),
-            row.get("symptom2", "").strip(),
-            row.get("symptom3", "").strip()
-        ]
-        
-        # Remove empty symptoms
-        condition_symptoms = [s for s in condition_symptoms if s]
-        
-        if not condition_symptoms:
-            continue
-        
-        # Calculate match score
-        score = calculate_symptom_match_score(symptoms, condition_symptoms)
-        
-        if score > best_score:
-            best_score = score
-            best_match = row
-    
-    # Return best match if score is above threshold, otherwise return unknown
-    if best_match and best_score >= 0.2:  # 20% similarity threshold
-        return (
-            best_match.get("condition", "Unknown"),
-            best_match.get("icd_code", "DNE"),
-            best_match.get("prescription", "Unknown"),
-            best_match.get("severity", "Unknown"),
-            best_match.get("SOD", "Unknown"),
-            best_match.get("diagnosis_status", "Unknown"),
-            best_match.get("Insurance", "Unknown")
-        )
-    
-    return "Unknown", "DNE", "Unknown", "Unknown", "Unknown", "Unknown", "Unknown"
 
-def validate_csv_structure(data):
-    """Validate that the CSV contains required fields for diagnosis."""
-    if not data:
-        return False, "No data found in CSV file"
-    
-    # Check for at least one symptom-related column
-    first_row = data[0]
-    symptom_columns = [
-        'symptoms', 'symptom', 'patient_symptoms', 'eye_symptoms',
-        'symptom1', 'symptom2', 'symptom3', 'symptom4', 'symptom5',
-        'primary_symptom', 'secondary_symptom', 'tertiary_symptom'
-    ]
-    
-    has_symptoms = any(col in first_row for col in symptom_columns)
-    if not has_symptoms:
-        return False, "No symptom columns found in CSV file"
-    
-    return True, "CSV structure is valid"
+def allowed_file(filename):
+    if not filename:
+        return False
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
         flash('No file part', 'error')
@@ -531,12 +969,12 @@ def upload_file():
         elif file_type == 'insurance':
             filename = 'insurance.csv'
         
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
         file.save(file_path)
         
         # Validate the uploaded CSV file
         data = read_csv(file_path)
-        is_valid, message = validate_csv_structure(data)
+        is_valid, message = validate_csv_structure(data, file_type)
         
         if not is_valid:
             os.remove(file_path)  # Remove invalid file
@@ -544,19 +982,23 @@ def upload_file():
             return redirect(url_for('index'))
         
         logger.info(f"Successfully uploaded {filename} with {len(data)} records")
-        flash(f'Successfully uploaded {filename} with {len(data)} patient records', 'success')
+        flash(f'Successfully uploaded {filename} with {len(data)} records', 'success')
         return redirect(url_for('index'))
     
     flash('Invalid file type. Please upload a CSV file.', 'error')
     return redirect(url_for('index'))
 
-@app.route('/process', methods=['POST'])
+@profiled_route
 def process_data():
+    scheduling_index = insurance_index = None
     try:
         # Update file paths
-        patient_data_file = os.path.join(app.config['UPLOAD_FOLDER'], "patient_data.csv")
+        patient_data_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "patient_data.csv")
         icd_cpt_file = "icd_cpt_codes_extended.csv"
-        results_file = os.path.join(app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
+        results_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
+        differential_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_differential.json")
+        scheduling_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "scheduling.csv")
+        insurance_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "insurance.csv")
 
         # Load patient data from CSV
         patient_data = read_csv(patient_data_file)
@@ -570,8 +1012,14 @@ def process_data():
             flash("Error: ICD/CPT codes file is missing or empty. Please ensure icd_cpt_codes_extended.csv is in the root directory.", 'error')
             return redirect(url_for('index'))
 
+        # Index the optional scheduling and insurance uploads by patient email
+        scheduling_index = load_optional_index(build_scheduling_index, scheduling_file)
+        insurance_index = load_optional_index(build_insurance_index, insurance_file)
+
         # Prepare diagnosis results
+        condition_index = build_condition_index(icd_cpt_data)
         results = []
+        differentials = []
         processed_count = 0
         error_count = 0
         
@@ -585,29 +1033,20 @@ def process_data():
                     error_count += 1
                     continue
                 
-                # Extract other relevant fields
-                patient_email = patient.get('email', patient.get('patient_email', 'unknown@email.com'))
-                affected_eye = patient.get('affected_eye', patient.get('eye', patient.get('affected-eye', 'Unknown')))
-                onset_date = patient.get('onset_date', patient.get('onset', patient.get('date', 'Unknown')))
-                
-                # Make diagnosis
-                diagnosis, icd_code, prescription, severity, SOD, diagnosis_status, insurance = diagnose_patient(symptoms, icd_cpt_data)
-                cpt_code = next((row["cpt_code"] for row in icd_cpt_data if row.get("icd_code") == icd_code), "DNE")
-
-                results.append({
-                    "patient_email": patient_email,
-                    "diagnosis": diagnosis,
-                    "icd_code": icd_code,
-                    "prescription": prescription,
-                    "cpt_code": cpt_code,
-                    "Eye": affected_eye,
-                    "Onset_date": onset_date,
-                    "Insurance": insurance,
-                    "Diagnosis_status": diagnosis_status,
-                    "SOD": SOD,
-                    "Severity": severity,
-                    "Symptoms": ', '.join(symptoms),
-                    "processed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                result, ranked = diagnose_csv_row(patient, symptoms, icd_cpt_data, condition_index)
+                _join_uploads(result, scheduling_index, insurance_index)
+                results.append(result)
+                differentials.append({
+                    "patient_email": result["patient_email"],
+                    "candidates": [
+                        {
+                            "condition": row.get("condition", "Unknown"),
+                            "icd_code": row.get("icd_code", "DNE"),
+                            "cpt_code": row.get("cpt_code", "DNE"),
+                            "score": round(score, 4)
+                        }
+                        for score, row in ranked
+                    ]
                 })
                 processed_count += 1
                 
@@ -617,12 +1056,12 @@ def process_data():
                 continue
 
         # Write results
-        fieldnames = [
-            "patient_email", "diagnosis", "icd_code", "prescription", "cpt_code",
-            "Eye", "Onset_date", "Diagnosis_status", "SOD", "Severity", "Insurance", "Symptoms", "processed_at"
-        ]
-        
-        if write_csv(results_file, fieldnames, results):
+        write_json(differential_file, differentials)
+
+        if write_csv(results_file, RESULT_FIELDNAMES, results):
+            if results:
+                with open(results_file, mode='rb') as f:
+                    _schedule_summary_precompute(_results_fingerprint(f.read()), results)
             flash(f"Diagnosis complete! Processed {processed_count} patients successfully. {error_count} errors encountered.", 'success')
         else:
             flash("Error saving results to file.", 'error')
@@ -633,10 +1072,15 @@ def process_data():
         logger.error(f"Error during data processing: {e}")
         flash(f"An error occurred during processing: {str(e)}", 'error')
         return redirect(url_for('index'))
+    finally:
+        # A spilled index owns a temporary SQLite file; remove it on every path.
+        for email_index in (scheduling_index, insurance_index):
+            if email_index is not None:
+                email_index.close()
 
-@app.route('/results')
+@profiled_route
 def view_results():
-    results_file = os.path.join(app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
+    results_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
     try:
         with open(results_file, mode='r', encoding='utf-8') as file:
             reader = csv.DictReader(file)
@@ -671,12 +1115,11 @@ def view_results():
         flash(f"An error occurred while reading results: {str(e)}", 'error')
         return redirect(url_for('index'))
 
-@app.route('/use_sample', methods=['POST'])
 def use_sample():
     """Copy the built-in sample CSV to uploads so users can test without their own file."""
     import shutil
     sample_file = 'sample_patient_data.csv'
-    dest_file = os.path.join(app.config['UPLOAD_FOLDER'], 'patient_data.csv')
+    dest_file = os.path.join(current_app.config['UPLOAD_FOLDER'], 'patient_data.csv')
     try:
         shutil.copy(sample_file, dest_file)
         data = read_csv(dest_file)
@@ -688,18 +1131,26 @@ def use_sample():
         flash(f'Error loading sample data: {str(e)}', 'error')
     return redirect(url_for('index'))
 
-@app.route('/download_results')
 def download_results():
     """Download results as CSV file."""
-    results_file = os.path.join(app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
+    results_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
     try:
         return send_file(results_file, as_attachment=True, download_name=f"diagnosis_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv")
     except FileNotFoundError:
         flash("No results file found.", 'error')
         return redirect(url_for('index'))
 
+def download_differential():
+    """Download the top-k differential diagnosis sidecar as JSON."""
+    differential_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_differential.json")
+    try:
+        return send_file(differential_file, as_attachment=True, download_name=f"diagnosis_differential_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    except FileNotFoundError:
+        flash("No differential diagnosis file found.", 'error')
+        return redirect(url_for('index'))
 
-@app.route('/chat', methods=['POST'])
+
+@profiled_route
 def chat():
     """Handle chatbot messages and return AI-generated responses as JSON."""
     data = request.get_json(silent=True)
@@ -714,10 +1165,11 @@ def chat():
         return jsonify({'response': _answer_general_app_question(user_message)})
 
     # Load the most recent diagnosis results
-    results_file = os.path.join(app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
+    results_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
     try:
-        with open(results_file, mode='r', encoding='utf-8') as f:
-            results = list(csv.DictReader(f))
+        with open(results_file, mode='rb') as f:
+            raw_results = f.read()
+        results = list(csv.DictReader(io.StringIO(raw_results.decode('utf-8'))))
     except FileNotFoundError:
         if _is_summary_request(user_message):
             return jsonify({
@@ -733,38 +1185,42 @@ def chat():
         return jsonify({'response': _answer_general_app_question(user_message)})
 
     analytics = _compute_results_analytics(results)
-    detailed_context = _format_analytics_for_prompt(analytics)
     deterministic_summary = _build_structured_summary(analytics)
 
+    cohort_frame = _get_cohort_frame(raw_results, results)
+
     # Return direct metric answers for common queries to avoid vague model replies.
-    direct_answer = _answer_analytics_question(user_message, analytics)
+    # Summary requests keep the summary path even when they name a breakdown.
+    cohort_answer = None
+    if not _is_summary_request(user_message):
+        cohort_answer = _answer_cohort_question(user_message, cohort_frame)
+    direct_answer = cohort_answer or _answer_analytics_question(user_message, analytics)
     if direct_answer:
         return jsonify({'response': direct_answer})
 
     if _is_summary_request(user_message):
-        prompt = (
-            "You are a clinical data analyst assistant. "
-            "Create a clear, professional summary with concrete numbers and practical interpretation. "
-            "Do not use generic filler. Keep all facts consistent with the data. "
-            "Include sections: Key Findings, Risk Priorities, and Recommended Actions. "
-            f"Dataset facts: {detailed_context} "
-            f"Baseline summary to preserve facts: {deterministic_summary} "
-            "Final summary:"
-        )
+        # Usually precomputed right after /process; otherwise generated once and shared.
+        response, error = _get_ai_summary(_results_fingerprint(raw_results), results)
     else:
         if any(token in user_message.lower() for token in ('workflow', 'upload', 'csv', 'how to', 'steps', 'model')):
             return jsonify({'response': _answer_general_app_question(user_message)})
 
-        prompt = (
-            "You are a professional medical assistant for an eye diagnosis dashboard. "
-            "Answer the user question using the dataset facts with concrete numbers and concise interpretation. "
-            "If the question is ambiguous, answer with the best available data and suggest one precise follow-up question. "
-            f"Dataset facts: {detailed_context} "
-            f"Question: {user_message} "
-            "Answer:"
+        prompt = _build_prompt(
+            QUESTION_PROMPT_INSTRUCTION,
+            [('Dataset facts:', _analytics_prompt_entries(analytics) + _cohort_prompt_entries(cohort_frame))],
+            'Answer:',
+            question=user_message,
         )
+        response, error = _submit_ai_response(prompt)
 
-    response, error = _generate_ai_response(prompt)
+    if error == AI_BUSY_ERROR:
+        if _is_summary_request(user_message):
+            return jsonify({'response': deterministic_summary})
+        return (
+            jsonify({'error': 'The AI assistant is busy right now. Please try again in a few seconds.'}),
+            429,
+            {'Retry-After': str(AI_RETRY_AFTER_SECONDS)},
+        )
     if error:
         logger.error("AI model error in /chat: %s", error)
         # Preserve functionality even when local model is unavailable.
@@ -789,7 +1245,101 @@ def chat():
 
     return jsonify({'response': response})
 
+@profiled_route
+def analytics_api():
+    """Group-by counts and cross-tabs over the current results as JSON.
+
+    Query parameters: group_by (one or two of diagnosis, severity, eye,
+    status; comma-separated), equality filters on those dimensions,
+    onset_from / onset_to (YYYY-MM-DD), last_days and as_of.
+    """
+    results_file = os.path.join(current_app.config['UPLOAD_FOLDER'], "diagnosis_results.csv")
+    try:
+        with open(results_file, mode='rb') as f:
+            raw_results = f.read()
+    except FileNotFoundError:
+        return jsonify({'error': 'No diagnosis results found. Run a diagnosis first.'}), 404
+
+    frame = _get_cohort_frame(raw_results)
+    if frame is None:
+        return jsonify({'error': 'Cohort analytics requires numpy. Install with: pip install numpy'}), 503
+
+    from analytics_engine import AnalyticsError, DIMENSIONS
+
+    def _split(values):
+        return [part.strip() for value in values for part in value.split(',') if part.strip()]
+
+    group_by = _split(request.args.getlist('group_by')) or ['diagnosis']
+    filters = {dim: _split(request.args.getlist(dim)) for dim in DIMENSIONS if request.args.get(dim)}
+    try:
+        last_days = request.args.get('last_days')
+        if last_days is not None:
+            if not last_days.strip().isdigit():
+                raise AnalyticsError(f"Invalid last_days '{last_days}'; use a whole number of days")
+            last_days = int(last_days)
+        as_of = request.args.get('as_of')
+        as_of = datetime.strptime(as_of, '%Y-%m-%d').date() if as_of else None
+        result = frame.query(
+            group_by, filters,
+            onset_from=request.args.get('onset_from'),
+            onset_to=request.args.get('onset_to'),
+            last_days=last_days,
+            as_of=as_of,
+        )
+    except (AnalyticsError, ValueError) as exc:
+        return jsonify({'error': str(exc)}), 400
+    return jsonify(result)
+
+
+def create_app(upload_folder=UPLOAD_FOLDER):
+    """Create the Flask app and register its routes.
+
+    The AI model, transformers and torch are still loaded lazily on the first
+    /chat request that needs them.
+    """
+    # Configure logging
+    logging.basicConfig(level=logging.INFO)
+
+    app = Flask(__name__)
+    app.secret_key = 'your_secret_key_here'
+    app.config['UPLOAD_FOLDER'] = upload_folder
+
+    # Ensure upload directory exists
+    os.makedirs(upload_folder, exist_ok=True)
+
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/upload', view_func=upload_file, methods=['POST'])
+    app.add_url_rule('/process', view_func=process_data, methods=['POST'])
+    app.add_url_rule('/results', view_func=view_results)
+    app.add_url_rule('/use_sample', view_func=use_sample, methods=['POST'])
+    app.add_url_rule('/download_results', view_func=download_results)
+    app.add_url_rule('/download_differential', view_func=download_differential)
+    app.add_url_rule('/chat', view_func=chat, methods=['POST'])
+    app.add_url_rule('/api/analytics', view_func=analytics_api)
+    return app
+
+
+_default_app = None
+_default_app_lock = threading.Lock()
+
+
+def __getattr__(name):
+    """Build the module-level `app` (used by `gunicorn Diagnosis:app`) on first access."""
+    global _default_app
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+        return _default_app
+
+
 if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        from batch_runner import main as batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+
     port = int(os.environ.get('PORT', 5000))
     logger.info("Starting Eye Diagnosis System...")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    create_app().run(host='0.0.0.0', port=port, debug=False)
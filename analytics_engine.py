@@ -0,0 +1,184 @@
+# analytics_engine.py
+"""
+Columnar cohort analytics over diagnosis results.
+
+Results are loaded once into dictionary-encoded NumPy columns (an int32 code
+per row plus a list of distinct values) and onset dates parsed as
+datetime64[D]. Group-by counts, cross-tabs and date-range filters are then
+answered with vectorized operations (boolean masks and np.bincount), so a
+cross-tab over a million rows takes milliseconds.
+"""
+import csv
+from datetime import date, timedelta
+
+import numpy as np
+
+from diagnosis_core import SEVERITY_LABELS
+
+# Public dimension name -> column in diagnosis_results.csv
+DIMENSIONS = {
+    'diagnosis': 'diagnosis',
+    'severity': 'Severity',
+    'eye': 'Eye',
+    'status': 'Diagnosis_status',
+}
+ONSET_COLUMN = 'Onset_date'
+
+
+class AnalyticsError(ValueError):
+    """Raised for an invalid analytics query (unknown dimension, bad date)."""
+
+
+def _encode(values):
+    """Dictionary-encode a sequence of strings into (int32 codes, categories)."""
+    lookup = {}
+    codes = np.fromiter(
+        (lookup.setdefault(value, len(lookup)) for value in values),
+        dtype=np.int32, count=len(values),
+    )
+    return codes, list(lookup)
+
+
+def _parse_dates(categories):
+    """Parse distinct date strings once; unparseable values become NaT."""
+    parsed = []
+    for value in categories:
+        try:
+            parsed.append(np.datetime64(value.strip()[:10], 'D'))
+        except (ValueError, AttributeError):
+            parsed.append(np.datetime64('NaT', 'D'))
+    return np.array(parsed, dtype='datetime64[D]')
+
+
+class CohortFrame:
+    """Dictionary-encoded result columns plus parsed onset dates."""
+
+    def __init__(self, columns, onset):
+        # columns: dimension -> (codes, categories)
+        self.columns = columns
+        self.onset = onset
+        self.size = len(onset)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a frame from diagnosis result dicts (as read from the results CSV)."""
+        columns = {}
+        for dimension, field in DIMENSIONS.items():
+            values = [(row.get(field) or 'Unknown').strip() or 'Unknown' for row in rows]
+            columns[dimension] = _encode(values)
+        onset_codes, onset_categories = _encode([row.get(ONSET_COLUMN) or '' for row in rows])
+        onset = _parse_dates(onset_categories)[onset_codes] if len(rows) else np.array([], dtype='datetime64[D]')
+        return cls(columns, onset)
+
+    @classmethod
+    def from_csv(cls, file_name):
+        with open(file_name, mode='r', encoding='utf-8', newline='') as file:
+            return cls.from_rows(list(csv.DictReader(file)))
+
+    def _dimension(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            raise AnalyticsError(
+                f"Unknown dimension '{name}'. Choose from: {', '.join(DIMENSIONS)}"
+            ) from None
+
+    def labels(self, dimension):
+        _codes, categories = self._dimension(dimension)
+        if dimension == 'severity':
+            return [SEVERITY_LABELS.get(value, value) for value in categories]
+        return list(categories)
+
+    def _codes_for(self, dimension, wanted):
+        """Codes of the categories matching `wanted` (case-insensitive; severity accepts labels)."""
+        _codes, categories = self._dimension(dimension)
+        wanted = {str(value).strip().lower() for value in wanted}
+        labels = self.labels(dimension)
+        return [
+            code for code, (value, label) in enumerate(zip(categories, labels))
+            if value.lower() in wanted or label.lower() in wanted
+        ]
+
+    def mask(self, filters=None, onset_from=None, onset_to=None, last_days=None, as_of=None):
+        """Boolean row mask for equality filters and an inclusive onset date range.
+
+        `filters` maps a dimension to a value or list of values. `last_days`
+        keeps onsets within the N days up to `as_of` (default: today).
+        """
+        selected = np.ones(self.size, dtype=bool)
+        for dimension, wanted in (filters or {}).items():
+            if isinstance(wanted, str):
+                wanted = [wanted]
+            codes, _categories = self._dimension(dimension)
+            selected &= np.isin(codes, self._codes_for(dimension, wanted))
+
+        if last_days is not None:
+            as_of = as_of or date.today()
+            try:
+                onset_from = as_of - timedelta(days=int(last_days))
+            except (OverflowError, ValueError):
+                raise AnalyticsError(
+                    f"last_days={last_days} before {as_of} is outside the supported date range"
+                ) from None
+            onset_to = as_of
+        if onset_from is not None or onset_to is not None:
+            # NaT compares False, so rows without a valid onset drop out.
+            if onset_from is not None:
+                selected &= self.onset >= _to_day(onset_from)
+            if onset_to is not None:
+                selected &= self.onset <= _to_day(onset_to)
+        return selected
+
+    def group_counts(self, dimension, mask=None):
+        """Counts per value of `dimension`, largest first, zero counts omitted."""
+        codes, _categories = self._dimension(dimension)
+        selected = codes if mask is None else codes[mask]
+        counts = np.bincount(selected, minlength=len(_categories))
+        labels = self.labels(dimension)
+        order = np.argsort(-counts, kind='stable')
+        return {labels[i]: int(counts[i]) for i in order if counts[i]}
+
+    def crosstab(self, row_dimension, column_dimension, mask=None):
+        """Row x column count matrix for two dimensions."""
+        row_codes, row_categories = self._dimension(row_dimension)
+        col_codes, col_categories = self._dimension(column_dimension)
+        if mask is not None:
+            row_codes, col_codes = row_codes[mask], col_codes[mask]
+        n_rows, n_cols = len(row_categories), len(col_categories)
+        flat = np.bincount(
+            row_codes.astype(np.int64) * n_cols + col_codes, minlength=n_rows * n_cols
+        )
+        matrix = flat.reshape(n_rows, n_cols)
+        # Drop all-zero rows and columns left by the filters.
+        keep_rows = np.flatnonzero(matrix.sum(axis=1))
+        keep_cols = np.flatnonzero(matrix.sum(axis=0))
+        row_labels = self.labels(row_dimension)
+        col_labels = self.labels(column_dimension)
+        return {
+            'rows': [row_labels[i] for i in keep_rows],
+            'columns': [col_labels[j] for j in keep_cols],
+            'counts': matrix[np.ix_(keep_rows, keep_cols)].tolist(),
+        }
+
+    def query(self, group_by, filters=None, onset_from=None, onset_to=None, last_days=None, as_of=None):
+        """Run a group-by (one dimension) or cross-tab (two dimensions) query as a JSON-ready dict."""
+        if not group_by or len(group_by) > 2:
+            raise AnalyticsError("group_by needs one or two dimensions")
+        selected = self.mask(filters, onset_from, onset_to, last_days, as_of)
+        result = {
+            'total': self.size,
+            'matched': int(selected.sum()),
+            'group_by': list(group_by),
+        }
+        if len(group_by) == 1:
+            result['counts'] = self.group_counts(group_by[0], selected)
+        else:
+            result['crosstab'] = self.crosstab(group_by[0], group_by[1], selected)
+        return result
+
+
+def _to_day(value):
+    try:
+        return np.datetime64(str(value)[:10], 'D')
+    except ValueError:
+        raise AnalyticsError(f"Invalid date '{value}'; use YYYY-MM-DD") from None
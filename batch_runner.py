@@ -0,0 +1,259 @@
+# batch_runner.py
+"""
+Headless batch diagnosis for very large patient CSV files.
+
+Usage:
+    python -m Diagnosis batch in.csv out.csv [--workers N] [--chunk-size ROWS]
+
+The input is streamed record by record, so memory use does not depend on
+file size. Rows are diagnosed with the same extract_symptoms_from_csv_row /
+diagnose_patient logic as /process, optionally across several processes.
+
+After each chunk is written, a checkpoint (input byte offset plus output row
+count and size) is saved next to the output file. Re-running the same
+command after an interruption resumes from the last checkpoint; pass
+--restart to start over.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from multiprocessing import Pool
+
+from diagnosis_core import (
+    RESULT_FIELDNAMES, _join_uploads, build_condition_index, diagnose_csv_row,
+    extract_symptoms_from_csv_row, read_csv,
+)
+
+DEFAULT_ICD_FILE = "icd_cpt_codes_extended.csv"
+DEFAULT_CHUNK_SIZE = 5000
+
+# Per-process matching state, set by _init_worker.
+_icd_data = None
+_condition_index = None
+
+
+def _init_worker(icd_file):
+    global _icd_data, _condition_index
+    _icd_data = read_csv(icd_file)
+    _condition_index = build_condition_index(_icd_data)
+
+
+def _diagnose_chunk(rows):
+    """Diagnose a list of patient rows. Returns (results, skipped_count)."""
+    results = []
+    skipped = 0
+    for patient in rows:
+        symptoms = extract_symptoms_from_csv_row(patient)
+        if not symptoms:
+            skipped += 1
+            continue
+        result, _ranked = diagnose_csv_row(patient, symptoms, _icd_data, _condition_index)
+        # No scheduling/insurance uploads in batch mode; fill the same defaults as /process.
+        _join_uploads(result, None, None)
+        results.append(result)
+    return results, skipped
+
+
+def _read_record(handle):
+    """Read one CSV record as bytes, following quoted fields across newlines."""
+    raw = handle.readline()
+    while raw and raw.count(b'"') % 2:
+        more = handle.readline()
+        if not more:
+            break
+        raw += more
+    return raw
+
+
+def _parse_record(raw, encoding='utf-8'):
+    return next(csv.reader(io.StringIO(raw.decode(encoding))), [])
+
+
+def read_header(input_file):
+    """Return (fieldnames, byte offset of the first data record)."""
+    with open(input_file, 'rb') as handle:
+        raw = _read_record(handle)
+        return _parse_record(raw, 'utf-8-sig'), handle.tell()
+
+
+def iter_chunks(input_file, fieldnames, start_offset, chunk_size):
+    """Yield (rows, end_offset) chunks of patient dicts starting at start_offset."""
+    with open(input_file, 'rb') as handle:
+        handle.seek(start_offset)
+        rows = []
+        while True:
+            raw = _read_record(handle)
+            if not raw:
+                break
+            if not raw.strip():
+                continue
+            rows.append(dict(zip(fieldnames, _parse_record(raw))))
+            if len(rows) >= chunk_size:
+                yield rows, handle.tell()
+                rows = []
+        if rows:
+            yield rows, handle.tell()
+
+
+def checkpoint_path(output_file):
+    return output_file + '.checkpoint.json'
+
+
+def load_checkpoint(output_file):
+    try:
+        with open(checkpoint_path(output_file), mode='r', encoding='utf-8') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(output_file, state):
+    """Write the checkpoint atomically so a crash never leaves it half-written."""
+    path = checkpoint_path(output_file)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, mode='w', encoding='utf-8') as file:
+        json.dump(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def _report_progress(state, input_size, started_at, rows_at_start, stream):
+    elapsed = max(time.monotonic() - started_at, 1e-9)
+    rate = (state['rows_read'] - rows_at_start) / elapsed
+    percent = (state['input_offset'] / input_size * 100) if input_size else 100.0
+    print(
+        f"  {state['rows_read']:,} rows read | {state['rows_written']:,} written | "
+        f"{percent:5.1f}% of input | {rate:,.0f} rows/s",
+        file=stream, flush=True,
+    )
+
+
+def run_batch(input_file, output_file, icd_file=DEFAULT_ICD_FILE, workers=1,
+              chunk_size=DEFAULT_CHUNK_SIZE, restart=False, progress_stream=sys.stderr):
+    """Diagnose input_file into output_file, resuming from a checkpoint if present.
+
+    Returns the final checkpoint state dict.
+    """
+    if not read_csv(icd_file):
+        raise ValueError(f"ICD/CPT codes file '{icd_file}' is missing or empty")
+    fieldnames, data_offset = read_header(input_file)
+    input_stat = os.stat(input_file)
+
+    state = None if restart else load_checkpoint(output_file)
+    if state is not None:
+        if state.get('input_size') != input_stat.st_size or state.get('input_file') != os.path.abspath(input_file):
+            raise ValueError(
+                f"Checkpoint {checkpoint_path(output_file)} belongs to a different input; "
+                "use --restart to start over"
+            )
+        if state.get('complete'):
+            print(f"Already complete: {state['rows_written']:,} rows in {output_file}; "
+                  "use --restart to run again", file=progress_stream, flush=True)
+            return state
+        # Drop any rows written after the last checkpoint.
+        with open(output_file, 'r+b') as out:
+            out.truncate(state['output_bytes'])
+        print(f"Resuming at row {state['rows_read']:,} (byte {state['input_offset']:,})",
+              file=progress_stream, flush=True)
+    else:
+        with open(output_file, mode='w', newline='', encoding='utf-8') as out:
+            csv.DictWriter(out, fieldnames=RESULT_FIELDNAMES).writeheader()
+            output_bytes = out.tell()
+        state = {
+            'input_file': os.path.abspath(input_file),
+            'input_size': input_stat.st_size,
+            'input_offset': data_offset,
+            'rows_read': 0,
+            'rows_written': 0,
+            'rows_skipped': 0,
+            'output_bytes': output_bytes,
+            'complete': False,
+        }
+        save_checkpoint(output_file, state)
+
+    started_at = time.monotonic()
+    rows_at_start = state['rows_read']
+    chunks = iter_chunks(input_file, fieldnames, state['input_offset'], chunk_size)
+
+    with open(output_file, mode='a', newline='', encoding='utf-8') as out:
+        writer = csv.DictWriter(out, fieldnames=RESULT_FIELDNAMES)
+
+        def commit(rows_read, end_offset, results, skipped):
+            writer.writerows(results)
+            out.flush()
+            os.fsync(out.fileno())
+            state['input_offset'] = end_offset
+            state['rows_read'] += rows_read
+            state['rows_written'] += len(results)
+            state['rows_skipped'] += skipped
+            state['output_bytes'] = out.tell()
+            save_checkpoint(output_file, state)
+            _report_progress(state, input_stat.st_size, started_at, rows_at_start, progress_stream)
+
+        if workers <= 1:
+            _init_worker(icd_file)
+            for rows, end_offset in chunks:
+                results, skipped = _diagnose_chunk(rows)
+                commit(len(rows), end_offset, results, skipped)
+        else:
+            # Keep a bounded number of chunks in flight so the reader never
+            # runs ahead of the writer; results are committed in input order.
+            with Pool(workers, initializer=_init_worker, initargs=(icd_file,)) as pool:
+                pending = deque()
+                for rows, end_offset in chunks:
+                    pending.append((len(rows), end_offset, pool.apply_async(_diagnose_chunk, (rows,))))
+                    if len(pending) >= workers * 2:
+                        rows_read, offset, job = pending.popleft()
+                        commit(rows_read, offset, *job.get())
+                while pending:
+                    rows_read, offset, job = pending.popleft()
+                    commit(rows_read, offset, *job.get())
+
+    state['complete'] = True
+    save_checkpoint(output_file, state)
+    return state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m Diagnosis batch',
+        description="Diagnose a patient CSV without the web interface.",
+    )
+    parser.add_argument('input', help="Patient CSV file")
+    parser.add_argument('output', help="Results CSV file to write")
+    parser.add_argument('--icd-file', default=DEFAULT_ICD_FILE, help="ICD/CPT codes CSV")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes (default: 1)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Rows per chunk; a checkpoint is written after each chunk")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore any existing checkpoint and start from the beginning")
+    args = parser.parse_args(argv)
+
+    started_at = time.monotonic()
+    try:
+        state = run_batch(
+            args.input, args.output, icd_file=args.icd_file, workers=args.workers,
+            chunk_size=max(1, args.chunk_size), restart=args.restart,
+        )
+    except (FileNotFoundError, ValueError) as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+
+    elapsed = time.monotonic() - started_at
+    print(
+        f"Done: {state['rows_written']:,} patients diagnosed, {state['rows_skipped']:,} rows "
+        f"without symptoms skipped, in {elapsed:.1f}s",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
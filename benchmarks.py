@@ -0,0 +1,101 @@
+# benchmarks.py
+"""
+Performance budgets for the Eye Diagnosis System.
+
+Run with `python benchmarks.py`; it prints a JSON report and exits non-zero
+if any measurement is over budget. Timings depend on the machine, so
+test_system.py only checks the parts that do not (no heavy imports).
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Importing the matching engine must stay cheap: the batch CLI and tests pay
+# for it in every process.
+CORE_IMPORT_BUDGET_MS = 100.0
+CORE_FORBIDDEN_MODULES = ('flask', 'werkzeug', 'jinja2', 'transformers', 'torch', 'tabulate')
+
+# A severity x eye cross-tab with a date-range filter over a million results
+# must come back in milliseconds.
+CROSSTAB_ROWS = 1_000_000
+CROSSTAB_BUDGET_MS = 50.0
+
+_IMPORT_PROBE = (
+    "import json, sys, time\n"
+    "start = time.perf_counter()\n"
+    "import diagnosis_core\n"
+    "elapsed = (time.perf_counter() - start) * 1000\n"
+    "loaded = [m for m in {forbidden!r} if m in sys.modules]\n"
+    "print(json.dumps([elapsed, loaded]))\n"
+)
+
+
+def bench_core_import(runs=5):
+    """Time `import diagnosis_core` in fresh interpreters and list heavy modules it pulled in."""
+    probe = _IMPORT_PROBE.format(forbidden=CORE_FORBIDDEN_MODULES)
+    timings = []
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', probe], capture_output=True, text=True, check=True, cwd=REPO_DIR
+        ).stdout
+        elapsed, modules = json.loads(output)
+        timings.append(elapsed)
+        loaded.update(modules)
+    median = statistics.median(timings)
+    return {
+        'name': 'core_import',
+        'median_ms': round(median, 2),
+        'budget_ms': CORE_IMPORT_BUDGET_MS,
+        'heavy_modules_loaded': sorted(loaded),
+        'ok': median <= CORE_IMPORT_BUDGET_MS and not loaded,
+    }
+
+
+def bench_crosstab(rows=CROSSTAB_ROWS, runs=5):
+    """Time a filtered two-dimension cross-tab on a synthetic CohortFrame."""
+    try:
+        import numpy as np
+        from analytics_engine import CohortFrame
+    except ImportError as exc:
+        return {'name': 'cohort_crosstab', 'skipped': str(exc), 'ok': True}
+
+    rng = np.random.default_rng(0)
+    columns = {
+        'diagnosis': (rng.integers(0, 20, rows, dtype=np.int32), [f"Condition {i}" for i in range(20)]),
+        'severity': (rng.integers(0, 3, rows, dtype=np.int32), ['10245', '10246', '10247']),
+        'eye': (rng.integers(0, 3, rows, dtype=np.int32), ['left', 'right', 'both']),
+        'status': (rng.integers(0, 2, rows, dtype=np.int32), ['Active', 'Relapse']),
+    }
+    onset = np.datetime64('2024-01-01') + rng.integers(0, 365, rows).astype('timedelta64[D]')
+    frame = CohortFrame(columns, onset)
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        frame.query(['severity', 'eye'], {'status': 'Active'},
+                    onset_from='2024-06-01', onset_to='2024-06-30')
+        timings.append((time.perf_counter() - start) * 1000)
+    median = statistics.median(timings)
+    return {
+        'name': 'cohort_crosstab',
+        'rows': rows,
+        'median_ms': round(median, 2),
+        'budget_ms': CROSSTAB_BUDGET_MS,
+        'ok': median <= CROSSTAB_BUDGET_MS,
+    }
+
+
+def main():
+    results = [bench_core_import(), bench_crosstab()]
+    print(json.dumps(results, indent=2))
+    return 0 if all(result['ok'] for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+# diagnosis_core.py
+"""
+Symptom-matching engine for the Eye Diagnosis System.
+
+Everything needed to read patient CSVs and diagnose them against the ICD/CPT
+table lives here, with only standard-library imports, so the batch CLI and
+tests can use it without starting Flask or loading the AI model.
+Diagnosis.py re-exports these names for existing callers.
+"""
+import csv
+import heapq
+import json
+import logging
+from datetime import datetime
+
+from join_index import EMAIL_COLUMNS, APPOINTMENT_DATE_COLUMNS, PAYER_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+def read_csv(file_name):
+    """Reads a CSV file and returns a list of dictionaries."""
+    try:
+        with open(file_name, mode='r', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            data = list(reader)
+            logger.info(f"Successfully loaded {len(data)} records from {file_name}")
+            return data
+    except FileNotFoundError:
+        logger.error(f"Error: The file '{file_name}' was not found.")
+        return []
+    except Exception as e:
+        logger.error(f"An error occurred while reading '{file_name}': {e}")
+        return []
+
+def write_csv(file_name, fieldnames, data):
+    """Writes a list of dictionaries to a CSV file."""
+    try:
+        with open(file_name, mode='w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(data)
+        logger.info(f"Successfully wrote {len(data)} records to {file_name}")
+        return True
+    except Exception as e:
+        logger.error(f"An error occurred while writing to '{file_name}': {e}")
+        return False
+
+def write_json(file_name, data):
+    """Writes JSON-serializable data to a file."""
+    try:
+        with open(file_name, mode='w', encoding='utf-8') as file:
+            json.dump(data, file, indent=2)
+        logger.info(f"Successfully wrote {len(data)} records to {file_name}")
+        return True
+    except Exception as e:
+        logger.error(f"An error occurred while writing to '{file_name}': {e}")
+        return False
+
+def extract_symptoms_from_csv_row(row):
+    """Extract symptoms from a CSV row. Handles various possible column names."""
+    symptoms = []
+    
+    # Common symptom column names
+    symptom_columns = [
+        'symptoms', 'symptom', 'patient_symptoms', 'eye_symptoms',
+        'symptom1', 'symptom2', 'symptom3', 'symptom4', 'symptom5',
+        'primary_symptom', 'secondary_symptom', 'tertiary_symptom'
+    ]
+    
+    for col in symptom_columns:
+        if col in row and row[col]:
+            # Handle both single symptoms and comma-separated lists
+            symptom_value = str(row[col]).strip()
+            if ',' in symptom_value:
+                # Split by comma and clean each symptom
+                symptom_list = [s.strip() for s in symptom_value.split(',') if s.strip()]
+                symptoms.extend(symptom_list)
+            else:
+                symptoms.append(symptom_value)
+    
+    # Remove duplicates while preserving order
+    seen = set()
+    unique_symptoms = []
+    for symptom in symptoms:
+        if symptom.lower() not in seen:
+            seen.add(symptom.lower())
+            unique_symptoms.append(symptom)
+    
+    return unique_symptoms
+
+def normalize_symptoms(symptoms):
+    """Normalize symptoms for better matching."""
+    normalized = []
+    for symptom in symptoms:
+        if symptom:
+            # Convert to lowercase and remove extra whitespace
+            clean_symptom = symptom.lower().strip()
+            normalized.append(clean_symptom)
+    return normalized
+
+DIAGNOSIS_MATCH_THRESHOLD = 0.2  # 20% similarity threshold
+DIFFERENTIAL_TOP_K = 5
+UNKNOWN_DIAGNOSIS = ("Unknown", "DNE", "Unknown", "Unknown", "Unknown", "Unknown", "Unknown")
+
+def calculate_symptom_match_score(patient_symptoms, condition_symptoms):
+    """Calculate a match score between patient symptoms and condition symptoms."""
+    patient_normalized = normalize_symptoms(patient_symptoms)
+    condition_normalized = normalize_symptoms(condition_symptoms)
+    
+    if not patient_normalized or not condition_normalized:
+        return 0.0
+    
+    # Calculate intersection
+    intersection = set(patient_normalized) & set(condition_normalized)
+    
+    # Calculate Jaccard similarity
+    union = set(patient_normalized) | set(condition_normalized)
+    
+    if not union:
+        return 0.0
+    
+    return len(intersection) / len(union)
+
+def diagnose_patient(symptoms, icd_data):
+    """Finds the best-matching ICD code for the given symptoms using improved algorithm."""
+    best_match = None
+    best_score = 0.0
+    
+    for row in icd_data:
+        condition_symptoms = [
+            row.get("symptom1", "").strip(),
+            row.get("symptom2", "").strip(),
+            row.get("symptom3", "").strip()
+        ]
+        
+        # Remove empty symptoms
+        condition_symptoms = [s for s in condition_symptoms if s]
+        
+        if not condition_symptoms:
+            continue
+        
+        # Calculate match score
+        score = calculate_symptom_match_score(symptoms, condition_symptoms)
+        
+        if score > best_score:
+            best_score = score
+            best_match = row
+    
+    # Return best match if score is above threshold, otherwise return unknown
+    if best_match and best_score >= DIAGNOSIS_MATCH_THRESHOLD:
+        return _diagnosis_fields(best_match)
+    
+    return UNKNOWN_DIAGNOSIS
+
+def _diagnosis_fields(row):
+    """Return the diagnosis tuple produced by diagnose_patient for an ICD row."""
+    return (
+        row.get("condition", "Unknown"),
+        row.get("icd_code", "DNE"),
+        row.get("prescription", "Unknown"),
+        row.get("severity", "Unknown"),
+        row.get("SOD", "Unknown"),
+        row.get("diagnosis_status", "Unknown"),
+        row.get("Insurance", "Unknown")
+    )
+
+def build_condition_index(icd_data):
+    """Build an inverted index from normalized condition symptom to ICD rows.
+
+    Only conditions that share at least one symptom with a patient can score
+    above zero, so ranking looks at those candidates instead of every row.
+    """
+    postings = {}
+    condition_sets = []
+    for position, row in enumerate(icd_data):
+        condition_symptoms = [
+            row.get("symptom1", "").strip(),
+            row.get("symptom2", "").strip(),
+            row.get("symptom3", "").strip()
+        ]
+        condition_set = set(normalize_symptoms([s for s in condition_symptoms if s]))
+        condition_sets.append(condition_set)
+        for symptom in condition_set:
+            postings.setdefault(symptom, []).append(position)
+    return {'postings': postings, 'condition_sets': condition_sets}
+
+def rank_conditions(symptoms, icd_data, k=5, index=None, min_score=0.0):
+    """Return up to k (score, row) pairs for the best-matching ICD rows.
+
+    Scores are the same Jaccard similarity used by diagnose_patient, and ties
+    keep file order, so the first entry is always diagnose_patient's choice.
+    A bounded heap of size k is kept over the candidate rows only.
+    """
+    if index is None:
+        index = build_condition_index(icd_data)
+    patient_set = set(normalize_symptoms(symptoms))
+    if not patient_set or k <= 0:
+        return []
+
+    candidates = set()
+    for symptom in patient_set:
+        candidates.update(index['postings'].get(symptom, ()))
+
+    heap = []
+    for position in candidates:
+        condition_set = index['condition_sets'][position]
+        score = len(patient_set & condition_set) / len(patient_set | condition_set)
+        if score <= 0.0 or score < min_score:
+            continue
+        # Lower score, then later file position, is "worse" and sits at the heap top.
+        entry = (score, -position)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    ranked = sorted(heap, reverse=True)
+    return [(score, icd_data[-neg_position]) for score, neg_position in ranked]
+
+def diagnose_patient_topk(symptoms, icd_data, k=5, index=None, min_score=0.0):
+    """Return up to k (condition, icd_code, cpt_code, score) tuples, best first."""
+    return [
+        (
+            row.get("condition", "Unknown"),
+            row.get("icd_code", "DNE"),
+            row.get("cpt_code", "DNE"),
+            round(score, 4)
+        )
+        for score, row in rank_conditions(symptoms, icd_data, k=k, index=index, min_score=min_score)
+    ]
+
+
+RESULT_FIELDNAMES = [
+    "patient_email", "diagnosis", "icd_code", "prescription", "cpt_code",
+    "Eye", "Onset_date", "Diagnosis_status", "SOD", "Severity", "Insurance", "Next_appointment",
+    "Symptoms", "processed_at"
+]
+
+# Display labels for the codes in the Severity column, shared by the results
+# page, the AI prompts and the cohort analytics.
+SEVERITY_LABELS = {'10245': 'High', '10246': 'Medium', '10247': 'Low'}
+
+def diagnose_csv_row(patient, symptoms, icd_data, index, k=DIFFERENTIAL_TOP_K):
+    """Diagnose one patient row and return (result_row, ranked_candidates).
+
+    The top-ranked candidate is diagnose_patient's answer; the full ranking
+    is returned for the differential diagnosis sidecar.
+    """
+    # Extract other relevant fields
+    patient_email = patient.get('email', patient.get('patient_email', 'unknown@email.com'))
+    affected_eye = patient.get('affected_eye', patient.get('eye', patient.get('affected-eye', 'Unknown')))
+    onset_date = patient.get('onset_date', patient.get('onset', patient.get('date', 'Unknown')))
+
+    ranked = rank_conditions(symptoms, icd_data, k=k, index=index)
+    if ranked and ranked[0][0] >= DIAGNOSIS_MATCH_THRESHOLD:
+        best_row = ranked[0][1]
+        diagnosis, icd_code, prescription, severity, SOD, diagnosis_status, insurance = _diagnosis_fields(best_row)
+        cpt_code = best_row.get("cpt_code", "DNE")
+    else:
+        diagnosis, icd_code, prescription, severity, SOD, diagnosis_status, insurance = UNKNOWN_DIAGNOSIS
+        cpt_code = "DNE"
+
+    result = {
+        "patient_email": patient_email,
+        "diagnosis": diagnosis,
+        "icd_code": icd_code,
+        "prescription": prescription,
+        "cpt_code": cpt_code,
+        "Eye": affected_eye,
+        "Onset_date": onset_date,
+        "Insurance": insurance,
+        "Diagnosis_status": diagnosis_status,
+        "SOD": SOD,
+        "Severity": severity,
+        "Symptoms": ', '.join(symptoms),
+        "processed_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    return result, ranked
+
+def _join_uploads(result, scheduling_index, insurance_index):
+    """Fill Next_appointment and Insurance from the scheduling and insurance uploads."""
+    email = result["patient_email"]
+    appointment = scheduling_index.get(email) if scheduling_index is not None else None
+    result["Next_appointment"] = appointment or "None scheduled"
+    payer = insurance_index.get(email) if insurance_index is not None else None
+    if payer:
+        result["Insurance"] = payer
+
+def validate_csv_structure(data, file_type='vitals'):
+    """Validate that the CSV contains required fields for its upload type."""
+    if not data:
+        return False, "No data found in CSV file"
+    
+    first_row = data[0]
+    if file_type == 'scheduling':
+        if not any(col in first_row for col in EMAIL_COLUMNS):
+            return False, "No email column found in scheduling CSV file"
+        if not any(col in first_row for col in APPOINTMENT_DATE_COLUMNS):
+            return False, "No appointment date column found in scheduling CSV file"
+        return True, "CSV structure is valid"
+    if file_type == 'insurance':
+        if not any(col in first_row for col in EMAIL_COLUMNS):
+            return False, "No email column found in insurance CSV file"
+        if not any(col in first_row for col in PAYER_COLUMNS):
+            return False, "No payer column found in insurance CSV file"
+        return True, "CSV structure is valid"
+
+    # Check for at least one symptom-related column
+    symptom_columns = [
+        'symptoms', 'symptom', 'patient_symptoms', 'eye_symptoms',
+        'symptom1', 'symptom2', 'symptom3', 'symptom4', 'symptom5',
+        'primary_symptom', 'secondary_symptom', 'tertiary_symptom'
+    ]
+    
+    has_symptoms = any(col in first_row for col in symptom_columns)
+    if not has_symptoms:
+        return False, "No symptom columns found in CSV file"
+    
+    return True, "CSV structure is valid"
@@ -0,0 +1,226 @@
+# inference_daemon.py
+"""
+Shared local inference daemon for the Eye Diagnosis System.
+
+Every gunicorn worker normally loads its own copy of Flan-T5. This daemon
+loads the model once and serves generation requests to all workers over a
+Unix domain socket.
+
+Protocol: each message is a 4-byte big-endian length followed by a UTF-8
+JSON object. Requests are {"prompt": "..."} (a prompt string or a
+Diagnosis._build_prompt spec); responses are
+{"response": "..." | null, "error": "..." | null}. A connection can carry
+any number of request/response pairs.
+
+Run it with:
+    python inference_daemon.py --socket /tmp/eye-diagnosis-ai.sock
+and start the web app with AI_DAEMON_SOCKET pointing at the same path.
+"""
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+_HEADER = struct.Struct('>I')
+MAX_FRAME_BYTES = 1024 * 1024
+
+
+class DaemonUnavailable(Exception):
+    """Raised by the client when the daemon cannot be reached."""
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(remaining)
+        if not chunk:
+            raise ConnectionError("Connection closed mid-frame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def send_frame(sock, payload):
+    """Serialize a dict as JSON and send it as one length-prefixed frame."""
+    body = json.dumps(payload).encode('utf-8')
+    if len(body) > MAX_FRAME_BYTES:
+        raise ValueError(f"Frame of {len(body)} bytes exceeds limit of {MAX_FRAME_BYTES}")
+    sock.sendall(_HEADER.pack(len(body)) + body)
+
+
+def recv_frame(sock):
+    """Read one length-prefixed frame. Returns None on a clean EOF."""
+    header = sock.recv(_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        header += _recv_exact(sock, _HEADER.size - len(header))
+    (length,) = _HEADER.unpack(header)
+    if length > MAX_FRAME_BYTES:
+        raise ValueError(f"Frame of {length} bytes exceeds limit of {MAX_FRAME_BYTES}")
+    return json.loads(_recv_exact(sock, length).decode('utf-8'))
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                message = recv_frame(self.request)
+            except (ConnectionError, ValueError) as exc:
+                logger.warning("Dropping daemon connection: %s", exc)
+                return
+            if message is None:
+                return
+
+            prompt = message.get('prompt') if isinstance(message, dict) else None
+            if not isinstance(message, dict):
+                reply = {'response': None, 'error': 'Invalid request'}
+            elif not prompt or not isinstance(prompt, (str, dict)):
+                reply = {'response': None, 'error': 'No prompt provided'}
+            else:
+                with server.slots:
+                    try:
+                        response, error = server.generate(prompt)
+                    except Exception as exc:
+                        logger.error("Daemon generation error: %s", exc)
+                        response, error = None, str(exc)
+                reply = {'response': response, 'error': error}
+
+            try:
+                send_frame(self.request, reply)
+            except OSError:
+                return
+
+
+class InferenceDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server that runs `generate(prompt) -> (response, error)`.
+
+    `generate` defaults to the in-process model path of the web app; tests
+    pass a stub so no model is needed.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, generate=None, slots=1):
+        if generate is None:
+            from Diagnosis import _generate_ai_response_local
+            generate = _generate_ai_response_local
+        self.generate = generate
+        self.slots = threading.BoundedSemaphore(max(1, slots))
+        self.socket_path = socket_path
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+class InferenceClient:
+    """Pooled client for InferenceDaemon. Safe to share between threads."""
+
+    def __init__(self, socket_path, pool_size=4, timeout=120.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as exc:
+            sock.close()
+            raise DaemonUnavailable(f"Cannot connect to {self.socket_path}: {exc}") from exc
+        return sock
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _checkin(self, sock):
+        try:
+            self._idle.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+    def generate(self, prompt):
+        """Send a prompt to the daemon and return (response, error).
+
+        Raises DaemonUnavailable if the daemon cannot be reached. A pooled
+        connection that went stale is retried once on a fresh connection.
+        """
+        sock, reused = self._checkout()
+        while True:
+            try:
+                send_frame(sock, {'prompt': prompt})
+                reply = recv_frame(sock)
+                if reply is None:
+                    raise ConnectionError("Daemon closed the connection")
+                break
+            except socket.timeout as exc:
+                sock.close()
+                return None, f"AI daemon timed out: {exc}"
+            except (OSError, ConnectionError) as exc:
+                sock.close()
+                if not reused:
+                    raise DaemonUnavailable(str(exc)) from exc
+                sock, reused = self._connect(), False
+
+        self._checkin(sock)
+        return reply.get('response'), reply.get('error')
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Eye Diagnosis System inference daemon")
+    parser.add_argument(
+        '--socket', default=os.environ.get('AI_DAEMON_SOCKET', '/tmp/eye-diagnosis-ai.sock'),
+        help="Unix domain socket path to listen on",
+    )
+    parser.add_argument(
+        '--slots', type=int, default=int(os.environ.get('AI_INFERENCE_SLOTS', 1)),
+        help="Number of generations allowed to run at once",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    from Diagnosis import _load_ai_model
+
+    success, error = _load_ai_model()
+    if not success:
+        raise SystemExit(f"Could not load AI model: {error}")
+
+    server = InferenceDaemon(args.socket, slots=args.slots)
+    logger.info("Inference daemon listening on %s", args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
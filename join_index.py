@@ -0,0 +1,152 @@
+# join_index.py
+"""
+Email-keyed hash indexes over the uploaded scheduling and insurance CSVs.
+
+/process probes these indexes once per patient while diagnosing, so joining
+N patients against M schedule rows costs O(N + M). An index keeps its
+entries in a dict until it grows past max_entries; it then spills them to
+a temporary SQLite file keyed on email, so memory stays bounded for very
+large uploads.
+"""
+import csv
+import logging
+import os
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = int(os.environ.get('JOIN_INDEX_MAX_ENTRIES', 500000))
+
+EMAIL_COLUMNS = ('email', 'patient_email', 'Email')
+APPOINTMENT_DATE_COLUMNS = ('appointment_date', 'next_appointment', 'appointment', 'date')
+APPOINTMENT_TIME_COLUMNS = ('appointment_time', 'time')
+PAYER_COLUMNS = ('payer', 'insurance', 'insurance_provider', 'provider', 'Insurance')
+
+
+def _first_value(row, columns):
+    for col in columns:
+        value = row.get(col)
+        if value and value.strip():
+            return value.strip()
+    return None
+
+
+def normalize_email(email):
+    return email.strip().lower() if email else None
+
+
+class EmailIndex:
+    """Hash index from normalized email to one value, with spill-to-disk.
+
+    `merge(existing, new)` decides which value is kept when an email appears
+    more than once; the default keeps the first value seen.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, merge=None):
+        self.max_entries = max_entries
+        self.merge = merge or (lambda existing, new: existing)
+        self._entries = {}
+        self._db = None
+        self._db_path = None
+
+    @property
+    def spilled(self):
+        return self._db is not None
+
+    def __len__(self):
+        if self._db is None:
+            return len(self._entries)
+        return self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def add(self, email, value):
+        key = normalize_email(email)
+        if not key or value is None:
+            return
+        if self._db is None:
+            existing = self._entries.get(key)
+            self._entries[key] = value if existing is None else self.merge(existing, value)
+            if len(self._entries) > self.max_entries:
+                self._spill()
+            return
+        existing = self.get(key)
+        if existing is not None:
+            value = self.merge(existing, value)
+        self._db.execute("INSERT OR REPLACE INTO entries (email, value) VALUES (?, ?)", (key, value))
+
+    def get(self, email):
+        key = normalize_email(email)
+        if not key:
+            return None
+        if self._db is None:
+            return self._entries.get(key)
+        row = self._db.execute("SELECT value FROM entries WHERE email = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _spill(self):
+        import sqlite3
+        import tempfile
+        fd, self._db_path = tempfile.mkstemp(prefix='join-index-', suffix='.sqlite')
+        os.close(fd)
+        logger.info("Join index exceeded %d entries; spilling to %s", self.max_entries, self._db_path)
+        self._db = sqlite3.connect(self._db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = OFF")
+        self._db.execute("PRAGMA synchronous = OFF")
+        self._db.execute("CREATE TABLE entries (email TEXT PRIMARY KEY, value TEXT)")
+        self._db.executemany("INSERT INTO entries (email, value) VALUES (?, ?)", self._entries.items())
+        self._entries = {}
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.unlink(self._db_path)
+        self._entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _stream_rows(file_name):
+    with open(file_name, mode='r', encoding='utf-8', newline='') as file:
+        yield from csv.DictReader(file)
+
+
+def build_scheduling_index(file_name, max_entries=DEFAULT_MAX_ENTRIES, today=None):
+    """Index each patient's next upcoming appointment from a scheduling CSV.
+
+    Appointments are compared as ISO-8601 strings (YYYY-MM-DD, optionally
+    followed by a time); ones before `today` are ignored.
+    """
+    today = today or datetime.now().strftime("%Y-%m-%d")
+    index = EmailIndex(max_entries, merge=min)
+    for row in _stream_rows(file_name):
+        appointment = _first_value(row, APPOINTMENT_DATE_COLUMNS)
+        if not appointment or appointment[:10] < today:
+            continue
+        time_of_day = _first_value(row, APPOINTMENT_TIME_COLUMNS)
+        if time_of_day and len(appointment) <= 10:
+            appointment = f"{appointment} {time_of_day}"
+        index.add(_first_value(row, EMAIL_COLUMNS), appointment)
+    return index
+
+
+def build_insurance_index(file_name, max_entries=DEFAULT_MAX_ENTRIES):
+    """Index each patient's payer from an insurance CSV (first row per email wins)."""
+    index = EmailIndex(max_entries)
+    for row in _stream_rows(file_name):
+        index.add(_first_value(row, EMAIL_COLUMNS), _first_value(row, PAYER_COLUMNS))
+    return index
+
+
+def load_optional_index(builder, file_name, **kwargs):
+    """Build an index if the upload exists; return None otherwise."""
+    if not os.path.exists(file_name):
+        return None
+    try:
+        return builder(file_name, **kwargs)
+    except Exception as e:
+        logger.error(f"An error occurred while indexing '{file_name}': {e}")
+        return None
@@ -0,0 +1,362 @@
+# loadtest.py
+"""
+Local load-test harness for the Eye Diagnosis System.
+
+Starts the app with a stub in place of _generate_ai_response, drives a mixed
+concurrent workload against /upload, /process, /results, /download_results
+and /chat, and prints latency percentiles, error rates and throughput as JSON.
+Runs fully offline; no model is downloaded.
+
+Usage:
+    python loadtest.py --users 16 --duration 30
+    python loadtest.py --server gunicorn --workers 4 --users 32 --output report.json
+
+The stub simulates generation with a delay of --stub-delay-ms plus up to
+--stub-jitter-ms of random jitter. Use --stub module:function to plug in a
+different generator with the same (prompt) -> (response, error) signature.
+"""
+import argparse
+import base64
+import http.client
+import importlib
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+
+SAMPLE_FILE = 'sample_patient_data.csv'
+
+# Relative weights of each action in the mixed workload.
+DEFAULT_MIX = {
+    'upload': 1,
+    'process': 1,
+    'results': 4,
+    'download_results': 2,
+    'chat': 2,
+}
+
+# Where each form route redirects on success. Both report failures by
+# redirecting to the index page with an "error" flash; /upload redirects there
+# on success too, so the flashed category decides.
+SUCCESS_REDIRECTS = {
+    'upload': '/',
+    'process': '/results',
+}
+
+
+def make_stub_generator(delay_ms=800, jitter_ms=400):
+    """Return a _generate_ai_response stand-in that sleeps like a real generation."""
+    def stub_generate(prompt):
+        time.sleep((delay_ms + random.uniform(0, jitter_ms)) / 1000.0)
+        return "Stub summary: 1 cohort analyzed with 3 key findings.", None
+    return stub_generate
+
+
+def _load_stub(spec, delay_ms, jitter_ms):
+    if not spec:
+        return make_stub_generator(delay_ms, jitter_ms)
+    module_name, _, attr = spec.partition(':')
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def stubbed_app():
+    """App factory for gunicorn workers, configured from LOADTEST_* variables."""
+    import Diagnosis
+    Diagnosis._generate_ai_response = _load_stub(
+        os.environ.get('LOADTEST_STUB'),
+        float(os.environ.get('LOADTEST_STUB_DELAY_MS', 800)),
+        float(os.environ.get('LOADTEST_STUB_JITTER_MS', 400)),
+    )
+    Diagnosis.app.config['UPLOAD_FOLDER'] = os.environ['LOADTEST_UPLOAD_FOLDER']
+    return Diagnosis.app
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Measure each route on its own instead of following its redirect."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def _multipart_body(fields, file_field, file_name, file_bytes):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    parts.append(
+        (f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+         f'filename="{file_name}"\r\nContent-Type: text/csv\r\n\r\n').encode()
+        + file_bytes + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def _build_request(base_url, action, sample_bytes):
+    if action == 'upload':
+        body, content_type = _multipart_body({'file_type': 'vitals'}, 'file', 'patients.csv', sample_bytes)
+        return urllib.request.Request(f'{base_url}/upload', data=body, headers={'Content-Type': content_type})
+    if action == 'process':
+        return urllib.request.Request(f'{base_url}/process', data=b'', method='POST')
+    if action == 'results':
+        return urllib.request.Request(f'{base_url}/results')
+    if action == 'download_results':
+        return urllib.request.Request(f'{base_url}/download_results')
+    if action == 'chat':
+        message = random.choice(['summarize the results', 'what does the data suggest about treatment?'])
+        body = json.dumps({'message': message, 'context': 'results'}).encode()
+        return urllib.request.Request(f'{base_url}/chat', data=body, headers={'Content-Type': 'application/json'})
+    raise ValueError(f"Unknown action: {action}")
+
+
+def _flashed_categories(headers):
+    """Categories of the messages flashed into the response's Flask session cookie.
+
+    The cookie is signed but not encrypted: a base64 JSON payload, zlib
+    compressed when it starts with a dot.
+    """
+    categories = []
+    for cookie in headers.get_all('Set-Cookie') or []:
+        name, _, value = cookie.split(';', 1)[0].partition('=')
+        if name.strip() != 'session' or not value:
+            continue
+        compressed = value.startswith('.')
+        payload = value.lstrip('.').split('.', 1)[0]
+        try:
+            data = base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4))
+            if compressed:
+                data = zlib.decompress(data)
+            flashes = json.loads(data).get('_flashes', [])
+        except (ValueError, zlib.error):
+            continue
+        for flashed in flashes:
+            # Flask tags (category, message) tuples as {" t": [...]}.
+            if isinstance(flashed, dict):
+                flashed = flashed.get(' t', [])
+            if flashed:
+                categories.append(flashed[0])
+    return categories
+
+
+def _redirect_failed(action, status, headers):
+    """True when a form route redirected somewhere other than its success page."""
+    if action not in SUCCESS_REDIRECTS or status not in (301, 302, 303, 307, 308):
+        return False
+    location = urllib.parse.urlsplit(headers.get('Location', '')).path
+    return location != SUCCESS_REDIRECTS[action] or 'error' in _flashed_categories(headers)
+
+
+def _timed_request(base_url, action, sample_bytes, timeout):
+    """Return (status, elapsed_seconds, failed).
+
+    status is None on a transport error; failed is True for a transport
+    error, a 5xx, or a form route that redirected back with an error.
+    """
+    request = _build_request(base_url, action, sample_bytes)
+    started = time.perf_counter()
+    headers = {}
+    try:
+        with _opener.open(request, timeout=timeout) as response:
+            response.read()
+            status, headers = response.status, response.headers
+    except urllib.error.HTTPError as exc:
+        exc.read()
+        status, headers = exc.code, exc.headers
+    except (urllib.error.URLError, http.client.HTTPException, OSError):
+        status = None
+    elapsed = time.perf_counter() - started
+    failed = status is None or status >= 500 or _redirect_failed(action, status, headers)
+    return status, elapsed, failed
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile.
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(samples, elapsed):
+    """Aggregate (action, status, seconds, failed) samples into the JSON report."""
+    def stats(entries):
+        latencies = sorted(seconds * 1000 for _, _, seconds, _ in entries)
+        errors = sum(1 for _, _, _, failed in entries if failed)
+        rejected = sum(1 for _, status, _, _ in entries if status == 429)
+        count = len(entries)
+        return {
+            'requests': count,
+            'errors': errors,
+            'error_rate': round(errors / count, 4) if count else 0.0,
+            'rejected_429': rejected,
+            'throughput_rps': round(count / elapsed, 2) if elapsed else 0.0,
+            'latency_ms': {
+                'p50': _round(_percentile(latencies, 50)),
+                'p90': _round(_percentile(latencies, 90)),
+                'p99': _round(_percentile(latencies, 99)),
+                'max': _round(latencies[-1] if latencies else None),
+                'mean': _round(sum(latencies) / count if count else None),
+            },
+        }
+
+    by_route = {}
+    for sample in samples:
+        by_route.setdefault(sample[0], []).append(sample)
+    return {
+        'duration_s': round(elapsed, 2),
+        'overall': stats(samples),
+        'routes': {action: stats(entries) for action, entries in sorted(by_route.items())},
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def run_load(base_url, users=8, duration=10.0, mix=None, timeout=60.0):
+    """Drive `users` concurrent clients for `duration` seconds and return the report."""
+    mix = mix or DEFAULT_MIX
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+    with open(SAMPLE_FILE, 'rb') as file:
+        sample_bytes = file.read()
+
+    # Make sure results exist before the mixed workload starts.
+    for action in ('upload', 'process'):
+        _timed_request(base_url, action, sample_bytes, timeout)
+
+    samples = []
+    samples_lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def user_loop(seed):
+        rng = random.Random(seed)
+        local = []
+        while time.monotonic() < deadline:
+            action = rng.choices(actions, weights)[0]
+            status, seconds, failed = _timed_request(base_url, action, sample_bytes, timeout)
+            local.append((action, status, seconds, failed))
+        with samples_lock:
+            samples.extend(local)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=user_loop, args=(seed,)) for seed in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(samples, time.monotonic() - started)
+
+
+def start_flask_server(upload_folder, stub):
+    """Serve the app from a background thread. Returns (base_url, stop)."""
+    from werkzeug.serving import make_server
+    import Diagnosis
+
+    Diagnosis._generate_ai_response = stub
+    Diagnosis.app.config['UPLOAD_FOLDER'] = upload_folder
+    server = make_server('127.0.0.1', 0, Diagnosis.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        thread.join()
+
+    return f'http://127.0.0.1:{server.server_port}', stop
+
+
+def start_gunicorn_server(upload_folder, args, port=8765):
+    """Run gunicorn with the stubbed app factory. Returns (base_url, stop)."""
+    env = dict(
+        os.environ,
+        LOADTEST_UPLOAD_FOLDER=upload_folder,
+        LOADTEST_STUB_DELAY_MS=str(args.stub_delay_ms),
+        LOADTEST_STUB_JITTER_MS=str(args.stub_jitter_ms),
+        LOADTEST_STUB=args.stub or '',
+    )
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+         '-b', f'127.0.0.1:{port}', 'loadtest:stubbed_app()'],
+        env=env,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited during start-up")
+        try:
+            with urllib.request.urlopen(base_url + '/', timeout=1):
+                break
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.1)
+    else:
+        process.terminate()
+        raise RuntimeError("gunicorn did not start within 10 seconds")
+
+    def stop():
+        process.terminate()
+        process.wait(timeout=10)
+
+    return base_url, stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the Eye Diagnosis System with a stub model.")
+    parser.add_argument('--server', choices=('flask', 'gunicorn'), default='flask')
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--threads', type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument('--users', type=int, default=8, help="Concurrent simulated users")
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds of sustained load")
+    parser.add_argument('--stub', help="module:function to use instead of the built-in stub")
+    parser.add_argument('--stub-delay-ms', type=float, default=800.0)
+    parser.add_argument('--stub-jitter-ms', type=float, default=400.0)
+    parser.add_argument('--mix', type=json.loads,
+                        help='Action weights as JSON, e.g. \'{"results": 5, "chat": 1}\'')
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    upload_folder = tempfile.mkdtemp(prefix='eye-loadtest-')
+    try:
+        if args.server == 'gunicorn':
+            base_url, stop = start_gunicorn_server(upload_folder, args)
+        else:
+            stub = _load_stub(args.stub, args.stub_delay_ms, args.stub_jitter_ms)
+            base_url, stop = start_flask_server(upload_folder, stub)
+        try:
+            report = run_load(base_url, users=args.users, duration=args.duration, mix=args.mix)
+        finally:
+            stop()
+    finally:
+        shutil.rmtree(upload_folder, ignore_errors=True)
+
+    report['config'] = {
+        'server': args.server, 'users': args.users, 'duration_s': args.duration,
+        'stub_delay_ms': args.stub_delay_ms, 'stub_jitter_ms': args.stub_jitter_ms,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, mode='w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,7 @@ This script demonstrates the improved functionality of the CSV-based diagnosis s
 
 import csv
 import os
-from Diagnosis import read_csv, extract_symptoms_from_csv_row, diagnose_patient, validate_csv_structure
+from diagnosis_core import read_csv, extract_symptoms_from_csv_row, diagnose_patient, diagnose_patient_topk, validate_csv_structure
 
 def test_csv_reading():
     """Test reading the sample CSV file."""
@@ -75,11 +75,508 @@ def test_diagnosis_algorithm():
             print(f"  Prescription: {prescription}")
             print(f"  Severity: {severity}")
 
+def test_topk_differential():
+    """Test that the top-k ranking agrees with the single best-match diagnosis."""
+    print("\n=== Testing Top-k Differential Diagnosis ===")
+    from diagnosis_core import build_condition_index, calculate_symptom_match_score
+
+    icd_data = read_csv('icd_cpt_codes_extended.csv')
+    patient_data = read_csv('sample_patient_data.csv')
+    index = build_condition_index(icd_data)
+
+    for patient in patient_data:
+        symptoms = extract_symptoms_from_csv_row(patient)
+        topk = diagnose_patient_topk(symptoms, icd_data, k=3, index=index)
+        assert len(topk) <= 3
+        assert [c[3] for c in topk] == sorted((c[3] for c in topk), reverse=True)
+
+        best = diagnose_patient(symptoms, icd_data)
+        if best[0] != "Unknown":
+            assert topk[0][:2] == best[:2], (topk[0], best)
+
+        # The heap over candidates must match a full scan of every condition.
+        full_scan = sorted(
+            (
+                (calculate_symptom_match_score(symptoms, [row.get(f"symptom{n}", "").strip() for n in (1, 2, 3) if row.get(f"symptom{n}", "").strip()]), -pos)
+                for pos, row in enumerate(icd_data)
+            ),
+            reverse=True,
+        )
+        expected = [icd_data[-neg]["icd_code"] for score, neg in full_scan if score > 0][:3]
+        assert [c[1] for c in topk] == expected, ([c[1] for c in topk], expected)
+    print(f"✓ Top-3 ranking matches best-match and full scan for {len(patient_data)} patients")
+
+def test_batch_resume():
+    """Test that an interrupted batch run resumes from its checkpoint."""
+    print("\n=== Testing Batch Checkpoint Resume ===")
+    import io
+    import tempfile
+    from batch_runner import run_batch, load_checkpoint
+
+    class InterruptAfterFirstChunk(io.StringIO):
+        def write(self, text):
+            super().write(text)
+            if 'rows read' in text:
+                raise KeyboardInterrupt
+
+    def without_timestamps(path):
+        return [{k: v for k, v in row.items() if k != 'processed_at'} for row in read_csv(path)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        full_output = os.path.join(tmp, 'full.csv')
+        resumed_output = os.path.join(tmp, 'resumed.csv')
+        run_batch('sample_patient_data.csv', full_output, chunk_size=3, progress_stream=io.StringIO())
+
+        try:
+            run_batch('sample_patient_data.csv', resumed_output, chunk_size=3,
+                      progress_stream=InterruptAfterFirstChunk())
+        except KeyboardInterrupt:
+            pass
+        checkpoint = load_checkpoint(resumed_output)
+        assert checkpoint['rows_read'] == 3 and not checkpoint['complete'], checkpoint
+        print(f"✓ Interrupted after {checkpoint['rows_read']} rows at byte {checkpoint['input_offset']}")
+
+        state = run_batch('sample_patient_data.csv', resumed_output, chunk_size=3,
+                          progress_stream=io.StringIO())
+        assert state['complete']
+        assert without_timestamps(resumed_output) == without_timestamps(full_output)
+        print(f"✓ Resumed run produced the same {state['rows_written']} rows as an uninterrupted run")
+
+        assert all(row['Next_appointment'] == 'None scheduled' for row in read_csv(full_output))
+        rerun_log = io.StringIO()
+        run_batch('sample_patient_data.csv', resumed_output, chunk_size=3, progress_stream=rerun_log)
+        assert rerun_log.getvalue().startswith('Already complete'), rerun_log.getvalue()
+        assert without_timestamps(resumed_output) == without_timestamps(full_output)
+        print("✓ Re-running a finished batch reports it as complete and leaves the output alone")
+
+def test_prompt_token_budget():
+    """Test that prompts fit the token budget and always keep the question."""
+    print("\n=== Testing Token-Budgeted Prompt Builder ===")
+    import Diagnosis
+
+    class WordTokenizer:
+        """Stand-in tokenizer: one token per word, with call counting."""
+        eos_token_id = 1
+
+        def __init__(self):
+            self.vocab = {}
+            self.calls = []
+
+        def _encode(self, text):
+            return [self.vocab.setdefault(word, len(self.vocab) + 2) for word in text.split()]
+
+        def __call__(self, text, add_special_tokens=False):
+            self.calls.append(text)
+            if isinstance(text, list):
+                return {'input_ids': [self._encode(t) for t in text]}
+            return {'input_ids': self._encode(text)}
+
+    results = [
+        {'diagnosis': f'Condition {i % 300}', 'Severity': '10245', 'Eye': 'left',
+         'Diagnosis_status': 'Active', 'prescription': f'Treatment {i % 200}'}
+        for i in range(2000)
+    ]
+    analytics = Diagnosis._compute_results_analytics(results)
+    question = "Which diagnoses need urgent follow-up this week?"
+    prompt = Diagnosis._build_prompt(
+        Diagnosis.QUESTION_PROMPT_INSTRUCTION,
+        [('Dataset facts:', Diagnosis._analytics_prompt_entries(analytics))],
+        'Answer:',
+        question=question,
+    )
+
+    tokenizer = WordTokenizer()
+    Diagnosis._prompt_token_cache.clear()
+    ids = Diagnosis._encode_prompt(prompt, tokenizer, max_tokens=128)
+    assert len(ids) <= 128, len(ids)
+    tail = tokenizer._encode("Question: " + question + " Answer:") + [tokenizer.eos_token_id]
+    assert ids[-len(tail):] == tail
+    assert ids[:5] == tokenizer._encode(Diagnosis.QUESTION_PROMPT_INSTRUCTION)[:5]
+    assert tokenizer._encode("Total patients: 2000.")[0] in ids
+    print(f"✓ Prompt trimmed to {len(ids)} of 128 tokens with the question intact")
+
+    tokenized_entries = sum(len(c) for c in tokenizer.calls if isinstance(c, list))
+    assert tokenized_entries < len(prompt['sections'][0]['entries'])
+    print(f"✓ Tokenized {tokenized_entries} of {len(prompt['sections'][0]['entries'])} entries")
+
+    tokenizer.calls.clear()
+    Diagnosis._encode_prompt(prompt, tokenizer, max_tokens=128)
+    assert Diagnosis.QUESTION_PROMPT_INSTRUCTION not in tokenizer.calls
+    print("✓ Static instruction prefix was served from the token cache")
+    Diagnosis._prompt_token_cache.clear()
+
+def test_load_harness():
+    """Smoke-test the offline load-test harness with a fast stub model."""
+    print("\n=== Testing Load-Test Harness ===")
+    import tempfile
+    import Diagnosis
+    import loadtest
+
+    original_generate = Diagnosis._generate_ai_response
+    original_folder = Diagnosis.app.config['UPLOAD_FOLDER']
+    original_precompute = Diagnosis.AI_SUMMARY_PRECOMPUTE
+    # Background summaries would outlive the test and run against later stubs.
+    Diagnosis.AI_SUMMARY_PRECOMPUTE = False
+    with tempfile.TemporaryDirectory() as tmp:
+        base_url, stop = loadtest.start_flask_server(tmp, loadtest.make_stub_generator(5, 5))
+        try:
+            # No patient data uploaded yet: /process redirects back with an error.
+            status, _seconds, failed = loadtest._timed_request(base_url, 'process', b'', 5)
+            assert status == 302 and failed
+            with open(loadtest.SAMPLE_FILE, 'rb') as f:
+                status, _seconds, failed = loadtest._timed_request(base_url, 'upload', f.read(), 5)
+            assert status == 302 and not failed
+            print("✓ Failed /process redirect counted as an error, successful /upload redirect was not")
+
+            report = loadtest.run_load(base_url, users=4, duration=1.0)
+        finally:
+            stop()
+            Diagnosis._generate_ai_response = original_generate
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+            Diagnosis.AI_SUMMARY_PRECOMPUTE = original_precompute
+
+    assert report['overall']['requests'] > 0
+    assert set(report['routes']) <= set(loadtest.DEFAULT_MIX)
+    for route, stats in report['routes'].items():
+        assert stats['latency_ms']['p50'] <= stats['latency_ms']['p99'] <= stats['latency_ms']['max']
+    print(f"✓ {report['overall']['requests']} requests at {report['overall']['throughput_rps']} req/s, "
+          f"p99 {report['overall']['latency_ms']['p99']} ms")
+
+def test_upload_joins():
+    """Test that /process joins scheduling and insurance uploads by email, including after a spill."""
+    print("\n=== Testing Scheduling and Insurance Joins ===")
+    import shutil
+    import tempfile
+    import Diagnosis
+    from join_index import build_scheduling_index
+
+    original_folder = Diagnosis.app.config['UPLOAD_FOLDER']
+    original_precompute = Diagnosis.AI_SUMMARY_PRECOMPUTE
+    Diagnosis.AI_SUMMARY_PRECOMPUTE = False
+    with tempfile.TemporaryDirectory() as tmp:
+        Diagnosis.app.config['UPLOAD_FOLDER'] = tmp
+        shutil.copy('sample_patient_data.csv', os.path.join(tmp, 'patient_data.csv'))
+        Diagnosis.write_csv(os.path.join(tmp, 'scheduling.csv'), ['email', 'appointment_date'], [
+            {'email': 'john.doe@email.com', 'appointment_date': '2999-03-01'},
+            {'email': 'JOHN.DOE@email.com', 'appointment_date': '2999-02-01'},
+            {'email': 'john.doe@email.com', 'appointment_date': '2000-01-01'},
+            {'email': 'jane.smith@email.com', 'appointment_date': '2999-05-05'},
+        ])
+        Diagnosis.write_csv(os.path.join(tmp, 'insurance.csv'), ['email', 'payer'], [
+            {'email': 'jane.smith@email.com', 'payer': 'Acme Health'},
+        ])
+
+        spilled = build_scheduling_index(os.path.join(tmp, 'scheduling.csv'), max_entries=1)
+        assert spilled.spilled and spilled.get('john.doe@email.com') == '2999-02-01'
+        spilled.close()
+        print("✓ Spilled index keeps the earliest upcoming appointment")
+
+        try:
+            Diagnosis.app.test_client().post('/process')
+            rows = {r['patient_email']: r for r in read_csv(os.path.join(tmp, 'diagnosis_results.csv'))}
+        finally:
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+            Diagnosis.AI_SUMMARY_PRECOMPUTE = original_precompute
+
+    assert rows['john.doe@email.com']['Next_appointment'] == '2999-02-01'
+    assert rows['jane.smith@email.com']['Next_appointment'] == '2999-05-05'
+    assert rows['jane.smith@email.com']['Insurance'] == 'Acme Health'
+    print("✓ Results enriched with next appointment and payer")
+
+    # A failure after indexing must still remove the spilled index's temp file.
+    indexes = []
+
+    def spilling_index(builder, file_name):
+        if not os.path.exists(file_name):
+            return None
+        index = builder(file_name, max_entries=1)
+        indexes.append(index._db_path)
+        return index
+
+    def failing_index(icd_data):
+        raise RuntimeError("condition index failed")
+
+    original_load, original_build = Diagnosis.load_optional_index, Diagnosis.build_condition_index
+    with tempfile.TemporaryDirectory() as tmp:
+        Diagnosis.app.config['UPLOAD_FOLDER'] = tmp
+        shutil.copy('sample_patient_data.csv', os.path.join(tmp, 'patient_data.csv'))
+        Diagnosis.write_csv(os.path.join(tmp, 'insurance.csv'), ['email', 'payer'], [
+            {'email': 'a@b.com', 'payer': 'A'}, {'email': 'c@d.com', 'payer': 'C'},
+        ])
+        Diagnosis.load_optional_index = spilling_index
+        Diagnosis.build_condition_index = failing_index
+        Diagnosis.AI_SUMMARY_PRECOMPUTE = False
+        try:
+            assert Diagnosis.app.test_client().post('/process').headers['Location'] == '/'
+        finally:
+            Diagnosis.load_optional_index, Diagnosis.build_condition_index = original_load, original_build
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+            Diagnosis.AI_SUMMARY_PRECOMPUTE = original_precompute
+    assert indexes and indexes[0] is not None and not os.path.exists(indexes[0]), indexes
+    print("✓ Spilled index file removed after a failed run")
+
+def test_summary_precompute():
+    """Test that /process precomputes the AI summary and /chat reuses it."""
+    print("\n=== Testing AI Summary Precompute ===")
+    import shutil
+    import tempfile
+    import threading
+    import time
+    import Diagnosis
+
+    calls = []
+    holders = []
+    started = threading.Event()
+    release = threading.Event()
+    release.set()
+
+    def slow_generate(prompt):
+        calls.append(prompt)
+        started.set()
+        time.sleep(0.3)
+        release.wait(5)
+        return "Key Findings: 9 patients analyzed, 3 high severity.", None
+
+    original_generate = Diagnosis._generate_ai_response
+    original_folder = Diagnosis.app.config['UPLOAD_FOLDER']
+    original_retry_after = Diagnosis.AI_RETRY_AFTER_SECONDS
+    original_retries = Diagnosis.AI_SUMMARY_BUSY_RETRIES
+    Diagnosis._generate_ai_response = slow_generate
+    Diagnosis.AI_RETRY_AFTER_SECONDS = 0.5
+    # Keep the background run waiting until the test releases the slots.
+    Diagnosis.AI_SUMMARY_BUSY_RETRIES = 1000
+    # Identical results processed within the same second share a fingerprint.
+    Diagnosis._summary_cache.clear()
+    with tempfile.TemporaryDirectory() as tmp:
+        Diagnosis.app.config['UPLOAD_FOLDER'] = tmp
+        shutil.copy('sample_patient_data.csv', os.path.join(tmp, 'patient_data.csv'))
+        try:
+            client = Diagnosis.app.test_client()
+            client.post('/process')
+            assert started.wait(5)
+
+            # Two clicks while the background generation is still running.
+            responses = []
+            def click():
+                responses.append(client.post('/chat', json={'message': 'summarize', 'context': 'results'}).get_json())
+            clicks = [threading.Thread(target=click) for _ in range(2)]
+            for t in clicks:
+                t.start()
+            for t in clicks:
+                t.join()
+            assert len(calls) == 1, len(calls)
+            assert all(r['response'].startswith('Key Findings') for r in responses), responses
+            print("✓ Summary requests joined the in-flight background generation")
+
+            cached = client.post('/chat', json={'message': 'summarize', 'context': 'results'}).get_json()
+            assert cached['response'].startswith('Key Findings') and len(calls) == 1
+            print("✓ Later summary request was served from the precomputed result")
+
+            # With every slot and queue position taken, the background run waits
+            # for an idle slot and a summary click must not wait with it.
+            release.clear()
+            capacity = Diagnosis.AI_INFERENCE_SLOTS + Diagnosis.AI_INFERENCE_QUEUE
+            holders = [
+                threading.Thread(target=Diagnosis._submit_ai_response, args=('hold',))
+                for _ in range(capacity)
+            ]
+            for t in holders:
+                t.start()
+            for _ in range(100):
+                if Diagnosis._ai_inference_load() == capacity:
+                    break
+                time.sleep(0.01)
+            with open(os.path.join(tmp, 'patient_data.csv'), mode='a', encoding='utf-8') as f:
+                f.write('\nx@y.com,x@y.com,"Eye redness, itching",Eye redness,itching,,left,left,left,'
+                        '2024-02-01,2024-02-01,2024-02-01\n')
+            client.post('/process')
+
+            summary_calls = [c for c in calls if c != 'hold']
+            busy = client.post('/chat', json={'message': 'summarize', 'context': 'results'}).get_json()
+            assert busy['response'].startswith('Clinical Results Summary'), busy
+            assert [c for c in calls if c != 'hold'] == summary_calls
+            # The click answered while the background run was still waiting, not after it gave up.
+            assert any(not future.done() for future in Diagnosis._summary_cache.values())
+            print("✓ Summary request did not wait for a background run stuck behind a full queue")
+        finally:
+            release.set()
+            for t in holders:
+                t.join()
+            # Let the background run finish before restoring the generator.
+            Diagnosis._summary_executor.submit(lambda: None).result(timeout=10)
+            Diagnosis._generate_ai_response = original_generate
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+            Diagnosis.AI_RETRY_AFTER_SECONDS = original_retry_after
+            Diagnosis.AI_SUMMARY_BUSY_RETRIES = original_retries
+
+def test_request_profiling():
+    """Test opt-in per-request profiling and its access check."""
+    print("\n=== Testing Request Profiling ===")
+    import tempfile
+    import threading
+    import Diagnosis
+
+    original_folder = Diagnosis.app.config['UPLOAD_FOLDER']
+    original_profiles = Diagnosis.PROFILE_FOLDER
+    original_generate = Diagnosis._generate_ai_response
+    with tempfile.TemporaryDirectory() as tmp:
+        Diagnosis.app.config['UPLOAD_FOLDER'] = tmp
+        Diagnosis.PROFILE_FOLDER = os.path.join(tmp, 'profiles')
+        Diagnosis.write_csv(
+            os.path.join(tmp, 'diagnosis_results.csv'),
+            Diagnosis.RESULT_FIELDNAMES,
+            [{'patient_email': 'a@b.com', 'diagnosis': 'Red Eye', 'Severity': '10245'}],
+        )
+        try:
+            client = Diagnosis.app.test_client()
+            assert 'X-Profile-Id' not in client.get('/results').headers
+
+            profiled = client.get('/results', headers={'X-Profile': '1'})
+            profile_id = profiled.headers.get('X-Profile-Id')
+            assert profiled.status_code == 200 and profile_id
+            for suffix in ('.pstats', '.txt'):
+                assert os.path.exists(os.path.join(Diagnosis.PROFILE_FOLDER, profile_id + suffix))
+            print(f"✓ Saved profile {profile_id}")
+
+            remote = client.get('/results?profile=1', environ_base={'REMOTE_ADDR': '203.0.113.9'})
+            assert remote.status_code == 200 and 'X-Profile-Id' not in remote.headers
+            print("✓ Remote profiling request without an admin token was not profiled")
+
+            running = []
+            peak = [0]
+            running_lock = threading.Lock()
+            hold_started = threading.Event()
+            release = threading.Event()
+
+            def cpu_bound_generation(prompt):
+                with running_lock:
+                    running.append(prompt)
+                    peak[0] = max(peak[0], len(running))
+                try:
+                    if prompt == 'hold':
+                        hold_started.set()
+                        release.wait(5)
+                    else:
+                        sum(i * i for i in range(50000))
+                    return "Stub answer with 1 number.", None
+                finally:
+                    with running_lock:
+                        running.remove(prompt)
+
+            Diagnosis._generate_ai_response = cpu_bound_generation
+            # Fill every inference slot, then send a profiled /chat.
+            holders = [threading.Thread(target=Diagnosis._submit_ai_response, args=('hold',))
+                       for _ in range(Diagnosis.AI_INFERENCE_SLOTS)]
+            for t in holders:
+                t.start()
+            assert hold_started.wait(5)
+            responses = []
+            chat_thread = threading.Thread(target=lambda: responses.append(client.post(
+                '/chat', headers={'X-Profile': '1'},
+                json={'message': 'what treatment fits these patients?', 'context': 'results'})))
+            chat_thread.start()
+            # Once admitted, an uncapped profiled generation would start right away.
+            for _ in range(200):
+                if Diagnosis._ai_inference_load() > Diagnosis.AI_INFERENCE_SLOTS:
+                    break
+                threading.Event().wait(0.01)
+            for _ in range(50):
+                if peak[0] > Diagnosis.AI_INFERENCE_SLOTS:
+                    break
+                threading.Event().wait(0.01)
+            release.set()
+            chat_thread.join()
+            for t in holders:
+                t.join()
+            chat = responses[0]
+            assert chat.status_code == 200
+            assert peak[0] <= Diagnosis.AI_INFERENCE_SLOTS, peak
+            with open(os.path.join(Diagnosis.PROFILE_FOLDER, chat.headers['X-Profile-Id'] + '.txt'),
+                      encoding='utf-8') as report:
+                assert 'cpu_bound_generation' in report.read()
+            print("✓ /chat profile includes the model generation and respects the slot limit")
+        finally:
+            Diagnosis._generate_ai_response = original_generate
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+            Diagnosis.PROFILE_FOLDER = original_profiles
+
+def test_core_import_dependencies():
+    """Test that the matching engine imports without web or ML dependencies."""
+    print("\n=== Testing Core Import Dependencies ===")
+    from benchmarks import bench_core_import
+
+    # The timing budget is enforced by `python benchmarks.py`, not here.
+    result = bench_core_import(runs=1)
+    assert result['heavy_modules_loaded'] == [], result
+    print(f"✓ diagnosis_core loads no web or ML modules ({result['median_ms']} ms)")
+
+def test_cohort_analytics():
+    """Test the NumPy cohort analytics API and chat answers."""
+    print("\n=== Testing Cohort Analytics ===")
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print("✗ numpy is not installed; skipping")
+        return
+    import shutil
+    import tempfile
+    import Diagnosis
+
+    original_folder = Diagnosis.app.config['UPLOAD_FOLDER']
+    original_generate = Diagnosis._generate_ai_response
+    original_precompute = Diagnosis.AI_SUMMARY_PRECOMPUTE
+    Diagnosis.AI_SUMMARY_PRECOMPUTE = False
+    with tempfile.TemporaryDirectory() as tmp:
+        Diagnosis.app.config['UPLOAD_FOLDER'] = tmp
+        shutil.copy('sample_patient_data.csv', os.path.join(tmp, 'patient_data.csv'))
+        try:
+            client = Diagnosis.app.test_client()
+            client.post('/process')
+            rows = read_csv(os.path.join(tmp, 'diagnosis_results.csv'))
+
+            table = client.get('/api/analytics?group_by=severity,eye').get_json()['crosstab']
+            high_left = sum(1 for r in rows if r['Severity'] == '10245' and r['Eye'] == 'left')
+            assert table['counts'][table['rows'].index('High')][table['columns'].index('left')] == high_left
+            print(f"✓ Severity x eye cross-tab: {table}")
+
+            windowed = client.get('/api/analytics?group_by=eye&severity=high&onset_from=2024-01-16').get_json()
+            expected = sum(1 for r in rows if r['Severity'] == '10245' and r['Onset_date'] >= '2024-01-16')
+            assert windowed['matched'] == expected, windowed
+            assert client.get('/api/analytics?group_by=bogus').status_code == 400
+            assert client.get('/api/analytics?group_by=eye&last_days=abc').status_code == 400
+            assert client.get('/api/analytics?group_by=eye&last_days=1000000').status_code == 400
+            assert client.get('/api/analytics?group_by=eye&as_of=0001-01-03&last_days=5').status_code == 400
+            huge = client.post('/chat', json={
+                'message': 'how many patients by eye in the last 1000000 days', 'context': 'results'
+            })
+            assert huge.status_code == 200 and huge.get_json()['response'].startswith('A total of'), huge.get_json()
+            print("✓ Date-range filter and input validation")
+
+            answer = client.post('/chat', json={
+                'message': 'high severity by eye for onsets in the last 30 days', 'context': 'results'
+            }).get_json()['response']
+            assert answer.startswith('High severity patients with onset in the last 30 days by eye'), answer
+            print(f"✓ Chat: {answer}")
+
+            def ask(message):
+                return client.post('/chat', json={'message': message, 'context': 'results'}).get_json()['response']
+
+            assert ask('how many patients per eye?').startswith('All patients by eye')
+            Diagnosis._generate_ai_response = lambda prompt: ("Model answer: 2 treatment options.", None)
+            assert ask('what treatment is recommended per diagnosis?') == "Model answer: 2 treatment options."
+            assert not ask('give me a summary by diagnosis').startswith('All patients')
+            print("✓ Only count questions take the cohort path; summaries and other questions do not")
+        finally:
+            Diagnosis._generate_ai_response = original_generate
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+            Diagnosis.AI_SUMMARY_PRECOMPUTE = original_precompute
+
 def test_file_structure():
     """Test that all required files are present."""
     print("\n=== Testing File Structure ===")
     required_files = [
         'Diagnosis.py',
+        'diagnosis_core.py',
         'icd_cpt_codes_extended.csv',
         'sample_patient_data.csv',
         'templates/index.html',
@@ -92,6 +589,111 @@ def test_file_structure():
         else:
             print(f"✗ {file_path} - MISSING")
 
+def test_chat_backpressure():
+    """Test that /chat sheds load once the inference slots and queue are full."""
+    print("\n=== Testing Chat Backpressure ===")
+    import tempfile
+    import threading
+    import Diagnosis
+
+    release = threading.Event()
+    original_generate = Diagnosis._generate_ai_response
+    original_folder = Diagnosis.app.config['UPLOAD_FOLDER']
+
+    def slow_generate(prompt):
+        release.wait(5)
+        return "Stub response with 1 number.", None
+
+    Diagnosis._generate_ai_response = slow_generate
+    with tempfile.TemporaryDirectory() as tmp:
+        Diagnosis.app.config['UPLOAD_FOLDER'] = tmp
+        Diagnosis.write_csv(
+            os.path.join(tmp, 'diagnosis_results.csv'),
+            ['patient_email', 'diagnosis', 'Severity'],
+            [{'patient_email': 'a@b.com', 'diagnosis': 'Red Eye', 'Severity': '10245'}],
+        )
+        capacity = Diagnosis.AI_INFERENCE_SLOTS + Diagnosis.AI_INFERENCE_QUEUE
+        holders = [
+            threading.Thread(target=Diagnosis._submit_ai_response, args=('hold',))
+            for _ in range(capacity)
+        ]
+        try:
+            for t in holders:
+                t.start()
+            # Wait until every slot and queue position is taken by the holders.
+            for _ in range(100):
+                if Diagnosis._ai_inference_load() == capacity:
+                    break
+                threading.Event().wait(0.01)
+
+            client = Diagnosis.app.test_client()
+            busy = client.post('/chat', json={'message': 'what does this mean', 'context': 'results'})
+            assert busy.status_code == 429, busy.status_code
+            assert busy.headers.get('Retry-After') == str(Diagnosis.AI_RETRY_AFTER_SECONDS)
+            print(f"✓ Question rejected with 429 (Retry-After: {busy.headers.get('Retry-After')})")
+
+            summary = client.post('/chat', json={'message': 'summarize', 'context': 'results'})
+            assert summary.status_code == 200
+            assert summary.get_json()['response'].startswith('Clinical Results Summary')
+            print("✓ Summary request fell back to the deterministic summary")
+
+            assert client.get('/').status_code == 200
+            print("✓ Non-chat routes stay responsive")
+        finally:
+            release.set()
+            for t in holders:
+                t.join()
+            Diagnosis._generate_ai_response = original_generate
+            Diagnosis.app.config['UPLOAD_FOLDER'] = original_folder
+
+def test_inference_daemon():
+    """Test generation through a stub inference daemon over a Unix socket."""
+    print("\n=== Testing Inference Daemon ===")
+    import socket
+    import tempfile
+    import threading
+    import Diagnosis
+    from inference_daemon import InferenceDaemon, recv_frame, send_frame
+
+    calls = []
+
+    def stub_generate(prompt):
+        calls.append(prompt)
+        return f"stub: {prompt}", None
+
+    original_socket = Diagnosis.AI_DAEMON_SOCKET
+    original_local = Diagnosis._generate_ai_response_local
+    with tempfile.TemporaryDirectory() as tmp:
+        socket_path = os.path.join(tmp, 'ai.sock')
+        server = InferenceDaemon(socket_path, generate=stub_generate)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            Diagnosis.AI_DAEMON_SOCKET = socket_path
+            for prompt in ('first', 'second'):
+                response, error = Diagnosis._generate_ai_response(prompt)
+                assert error is None and response == f"stub: {prompt}", (response, error)
+            print(f"✓ Daemon answered {len(calls)} prompts")
+
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+                send_frame(sock, ['not', 'an', 'object'])
+                assert recv_frame(sock) == {'response': None, 'error': 'Invalid request'}
+                send_frame(sock, {'prompt': 'still served'})
+                assert recv_frame(sock)['response'] == 'stub: still served'
+            print("✓ Non-object frame got an error reply and the connection stayed usable")
+
+            Diagnosis.AI_DAEMON_SOCKET = os.path.join(tmp, 'missing.sock')
+            Diagnosis._generate_ai_response_local = lambda prompt: ("local", None)
+            response, error = Diagnosis._generate_ai_response('third')
+            assert response == "local", response
+            print("✓ Fell back to the in-process model when the daemon was unreachable")
+        finally:
+            server.shutdown()
+            server.server_close()
+            Diagnosis.AI_DAEMON_SOCKET = original_socket
+            Diagnosis._generate_ai_response_local = original_local
+
 def main():
     """Run all tests."""
     print("Eye Diagnosis System - Functionality Test")
@@ -102,6 +704,17 @@ def main():
     test_csv_validation()
     test_symptom_extraction()
     test_diagnosis_algorithm()
+    test_topk_differential()
+    test_batch_resume()
+    test_prompt_token_budget()
+    test_load_harness()
+    test_upload_joins()
+    test_summary_precompute()
+    test_request_profiling()
+    test_core_import_dependencies()
+    test_cohort_analytics()
+    test_chat_backpressure()
+    test_inference_daemon()
     
     print("\n" + "=" * 50)
     print("Test completed!")